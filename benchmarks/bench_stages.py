@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks: every stage of face_clustering timed on synthetic faces,
+offline and on CPU (no dataset or model weights needed).
+
+    python benchmarks/bench_stages.py --amount 1000 --clusters 16 --output bench.json
+"""
+
+import os
+import sys
+import argparse
+import json
+import time
+import numpy as np
+
+from collections import deque
+from math import sqrt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import face_clustering as fc
+from face_clustering import cv2, sklearn_cluster, Clustering, RSSSampler
+
+def make_synthetic_faces(folder, amount, size=(178, 218), seed=0):
+  '''Writes [amount] synthetic (w, h) JPEG "faces" (an ellipse with eyes
+     and mouth on a noisy background) to [folder], deterministically.
+     
+     Returns the list of paths.
+  '''
+  rng = np.random.default_rng(seed)
+  w, h = size
+  paths = []
+  os.makedirs(folder, exist_ok=True)
+  
+  for i in range(amount):
+    img = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    skin = tuple(int(c) for c in rng.integers(60, 256, 3))
+    center = (w // 2 + int(rng.integers(-10, 11)), h // 2 + int(rng.integers(-10, 11)))
+    
+    cv2.ellipse(img, center, (w // 3, h // 3), 0, 0, 360, skin, -1)
+    cv2.circle(img, (center[0] - w // 8, center[1] - h // 10), w // 20, (0, 0, 0), -1)
+    cv2.circle(img, (center[0] + w // 8, center[1] - h // 10), w // 20, (0, 0, 0), -1)
+    cv2.ellipse(img, (center[0], center[1] + h // 8), (w // 8, h // 30), 0, 0, 180, (40, 40, 160), -1)
+    
+    path = os.path.join(folder, f'{i:06d}.jpg')
+    cv2.imwrite(path, img)
+    paths.append(path)
+  
+  return paths
+
+class StubModel:
+  '''Deterministic stand-in for the attribute model: a fixed random
+     projection of a downsampled image, squashed into [0, 1] probabilities.
+  '''
+  def __init__(self, num_features=37, seed=0):
+    self.num_features = num_features
+    self.seed = seed
+    self.projection = None
+  
+  def predict_on_batch(self, batch):
+    pixels = np.asarray(batch, dtype=np.float32)[:, ::8, ::8, :].reshape(len(batch), -1)
+    
+    if self.projection is None:
+      rng = np.random.default_rng(self.seed)
+      self.projection = rng.standard_normal((pixels.shape[1], self.num_features)).astype(np.float32)
+    
+    logits = (pixels - 0.5) @ self.projection / sqrt(pixels.shape[1])
+    return 1 / (1 + np.exp(-4 * logits))
+
+def benchmark_stage(results, stage, items, function, *args, **kwargs):
+  '''Runs function(*args, **kwargs), appending its timings and its memory
+     (the peak resident memory during the stage, and its growth over the
+     memory at the start) to [results].
+  '''
+  with RSSSampler() as memory:
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+  
+  results.append({ 'stage': stage, 'items': items, 'seconds': seconds,
+                   'throughput': items / seconds if seconds > 0 else None,
+                   'latency_ms': 1000 * seconds / items if items > 0 else None,
+                   'peak_rss_mb': memory.peak_mb, 'rss_growth_mb': memory.peak_mb - memory.start_mb })
+  return output
+
+def run_benchmark(folder, amount=1000, features_name=None, num_clusters=16, output_path=None, seed=0):
+  '''Times every stage of the pipeline on [amount] synthetic faces (written
+     to [folder], once), with a StubModel in place of the attribute model:
+     scan, decode, inference, data-frame, Clustering.fit per method,
+     evaluate, Cluster.get_image and get_eigenface.
+     
+     Returns the results as a dict, also written as JSON to output_path.
+  '''
+  features_name = features_name or fc.chosen_features
+  images_folder = os.path.join(folder, f'faces-{amount}-{seed}')
+  
+  if not os.path.exists(images_folder):
+    make_synthetic_faces(images_folder, amount, seed=seed)
+  
+  index_path = os.path.normpath(images_folder) + '.index.npz'
+  if os.path.exists(index_path):
+    os.remove(index_path)  # time a cold scan
+  
+  # cold, disk-less image loading
+  saved = fc.thumbnails, fc.image_store
+  fc.thumbnails, fc.image_store = fc.ThumbnailCache(None), None
+  
+  model = StubModel(num_features=len(fc.dict_feature_name_to_index), seed=seed)
+  results = []
+  
+  try:
+    paths = benchmark_stage(results, 'scan', amount, fc.image_paths_from_folder, images_folder)
+    fc.load_reshape_img(paths[0], fc.TARGET_SIZE)  # imports keras outside of the timings
+    
+    # every image is discarded once decoded, as the memory would grow with amount
+    benchmark_stage(results, 'decode', amount,
+                    lambda: deque((fc.load_reshape_img(path, fc.TARGET_SIZE) for path in paths), maxlen=0))
+    benchmark_stage(results, 'infere_labels', amount, fc.infere_labels, model, paths, verbose=0)
+    df = benchmark_stage(results, 'dataframe_from_folder_or_labels', amount, fc.dataframe_from_folder_or_labels,
+                         features_name, images_folder, model=model, verbose=0)
+    
+    methods = {
+      'KMeans': sklearn_cluster.KMeans(n_clusters=num_clusters, n_init=1, random_state=seed),
+      'MiniBatchKMeans': sklearn_cluster.MiniBatchKMeans(n_clusters=num_clusters, n_init=1, random_state=seed),
+      'Birch': sklearn_cluster.Birch(n_clusters=num_clusters),
+      'DBSCAN': sklearn_cluster.DBSCAN(eps=1.5, min_samples=5),
+      'AgglomerativeClustering': sklearn_cluster.AgglomerativeClustering(n_clusters=num_clusters),
+    }
+    
+    for name, method in methods.items():
+      clustering = Clustering(method)
+      clusters = benchmark_stage(results, f'fit.{name}', amount, clustering.fit, df)
+    
+    kmeans = Clustering(methods['KMeans'])
+    clusters = kmeans.fit(df)
+    benchmark_stage(results, 'evaluate', amount, kmeans.evaluate)
+    
+    members = sum(min(len(cluster), 256) for cluster in clusters)
+    benchmark_stage(results, 'Cluster.get_image', members, lambda: [cluster.get_image() for cluster in clusters])
+    benchmark_stage(results, 'Cluster.get_eigenface', amount, lambda: [cluster.get_eigenface() for cluster in clusters])
+  finally:
+    fc.thumbnails, fc.image_store = saved
+  
+  report = { 'amount': amount, 'num_clusters': num_clusters, 'features': list(features_name),
+             'seed': seed, 'cpu_count': os.cpu_count(), 'stages': results }
+  
+  if output_path is not None:
+    with open(output_path, 'w') as f:
+      json.dump(report, f, indent=2)
+  
+  return report
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Times every stage of face_clustering on synthetic faces.')
+  parser.add_argument('--folder', default='benchmark')
+  parser.add_argument('--amount', type=int, default=1000)
+  parser.add_argument('--clusters', type=int, default=16)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=None)
+  args = parser.parse_args(argv)
+  
+  report = run_benchmark(args.folder, amount=args.amount, num_clusters=args.clusters,
+                         output_path=args.output, seed=args.seed)
+  
+  for stage in report['stages']:
+    print(f"{stage['stage']:>32}: {stage['seconds']:8.3f}s {stage['throughput'] or 0:10.1f}/s")
+
+if __name__ == '__main__':
+  main()
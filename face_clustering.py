@@ -1,88 +1,440 @@
 # -*- coding: utf-8 -*-
-"""UL19_Clustering.ipynb
+"""Face clustering on the facial attributes inferred by a MobileNetV2 model.
 
-Automatically generated by Colaboratory.
-
-Original file is located at
+Originally exported from the UL19_Clustering.ipynb Colaboratory notebook:
     https://colab.research.google.com/github/Luca96/face-clustering/blob/master/notebook/UL19_Clustering.ipynb
-"""
 
-# Commented out IPython magic to ensure Python compatibility.
-!pip install wget
+It can be imported as a module, or run from the command line:
+    python face_clustering.py download celeba lfw weights
+    python face_clustering.py infer celeba-dataset/img_align_celeba/img_align_celeba lfw --output features.npz
+    python face_clustering.py cluster features.npz --method kmeans --clusters 16 --output clustering
+    python face_clustering.py render clustering --output-dir report
+
+Keras, OpenCV, matplotlib, scikit-learn and scipy are imported lazily, on 
+first use, so that importing this module (or clustering cached features) 
+doesn't pay for them.
+"""
 
 import os
 import pandas as pd
 import numpy as np
-import cv2    
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-import keras
-import random
-import wget
+import argparse
+import functools
+import hashlib
+import importlib
+import inspect
+import json
+import multiprocessing
+import pickle
+import subprocess
+import threading
+import time
+
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from math import sqrt
+from multiprocessing import shared_memory
+from statistics import NormalDist
 
-from keras.preprocessing.image import img_to_array, load_img
+from PIL import Image
 
-plt.style.use('ggplot')
+class LazyModule:
+  '''A module imported on first use (attribute access): keras alone takes 
+     seconds to import. on_import(module) runs once, right after the import.
+  '''
+  def __init__(self, name, on_import=None):
+    self.__dict__.update(name=name, on_import=on_import, module=None)
+  
+  def __getattr__(self, attr):
+    module = self.__dict__['module']
+    
+    if module is None:
+      module = importlib.import_module(self.__dict__['name'])
+      self.__dict__['module'] = module
+      
+      if self.__dict__['on_import'] is not None:
+        self.__dict__['on_import'](module)
+    
+    return getattr(module, attr)
+
+cv2         = LazyModule('cv2')
+plt         = LazyModule('matplotlib.pyplot', on_import=lambda plt: plt.style.use('ggplot'))
+gridspec    = LazyModule('matplotlib.gridspec')
+keras       = LazyModule('keras')
+keras_image = LazyModule('keras.preprocessing.image')
+hierarchy   = LazyModule('scipy.cluster.hierarchy')
+
+sklearn_cluster       = LazyModule('sklearn.cluster')
+sklearn_metrics       = LazyModule('sklearn.metrics')
+sklearn_decomposition = LazyModule('sklearn.decomposition')
+sklearn_selection     = LazyModule('sklearn.model_selection')
+
+# clustering methods, still importable from here (e.g. from face_clustering import KMeans)
+CLUSTERING_METHODS = ['DBSCAN', 'KMeans', 'AgglomerativeClustering', 'SpectralClustering',
+                      'OPTICS', 'Birch', 'MiniBatchKMeans']
+
+def __getattr__(name):
+  if name in CLUSTERING_METHODS:
+    return getattr(sklearn_cluster, name)
+  
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # %matplotlib inline
 
-"""# 1. Dataset
-* Download, unzip and load CelebA dataset
-* Optionally download and extract LFW dataset
-"""
+# Instrumentation: per-stage timers and counters, off by default
 
-# downloading CelebA
+def peak_rss_mb():
+  '''Peak resident memory of this process so far, in MB.'''
+  import resource
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
-!pip install kaggle
+def rss_mb():
+  '''Current resident memory of this process, in MB (the peak so far where
+     /proc isn't available).
+  '''
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+  except OSError:
+    return peak_rss_mb()
+
+class RSSSampler:
+  '''Samples the resident memory every [interval] seconds on a background
+     thread, while in a with block: peak_mb is the highest sample, so that
+     every stage gets its own peak (ru_maxrss is the process lifetime one).
+  '''
+  def __init__(self, interval=0.005):
+    self.interval = interval
+    self.start_mb = None
+    self.peak_mb = None
+    self.stop = threading.Event()
+  
+  def sample(self):
+    while not self.stop.wait(self.interval):
+      self.peak_mb = max(self.peak_mb, rss_mb())
+  
+  def __enter__(self):
+    self.start_mb = self.peak_mb = rss_mb()
+    self.thread = threading.Thread(target=self.sample, daemon=True)
+    self.thread.start()
+    return self
+  
+  def __exit__(self, *exc):
+    self.stop.set()
+    self.thread.join()
+    self.peak_mb = max(self.peak_mb, rss_mb())
+
+class Profiler:
+  '''Collects timings and counters of the pipeline stages:
+      - timers: calls, total time, items/sec and latency percentiles,
+      - counters: e.g. cache hits and misses (hit rates are reported for
+        every 'name.hits' / 'name.misses' pair).
+     It's off by default: when disabled, instrumented code only pays an 
+     attribute check.
+  '''
+  def __init__(self):
+    self.enabled = False
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.reset()
+  
+  def enable(self):
+    self.enabled = True
+  
+  def disable(self):
+    self.enabled = False
+  
+  def reset(self):
+    self.timings = defaultdict(list)  # name -> [(seconds, items)]
+    self.counters = defaultdict(int)
+  
+  def record(self, name, seconds, items=0):
+    with self.lock:
+      self.timings[name].append((seconds, items))
+  
+  def count(self, name, amount=1):
+    with self.lock:
+      self.counters[name] += int(amount)
+  
+  def report(self):
+    '''Returns the collected statistics as a dict.'''
+    timers = dict()
+    
+    for name, timings in self.timings.items():
+      seconds = np.array([t for t, _ in timings])
+      items = sum(i for _, i in timings)
+      total = seconds.sum()
+      p50, p90, p99 = np.percentile(seconds * 1000, [50, 90, 99])
+      timers[name] = { 'calls': len(seconds), 'seconds': total, 'items': items,
+                       'items_per_sec': items / total if total > 0 else None,
+                       'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99 }
+    
+    hit_rates = dict()
+    
+    for name, hits in self.counters.items():
+      if name.endswith('.hits'):
+        base = name[:-len('.hits')]
+        total = hits + self.counters.get(base + '.misses', 0)
+        hit_rates[base] = hits / total if total > 0 else None
+    
+    return { 'timers': timers, 'counters': dict(self.counters), 'hit_rates': hit_rates,
+             'peak_rss_mb': peak_rss_mb() }
+  
+  def export(self, path=None, logger=None):
+    '''Writes the report as JSON to path, and/or to the given logger.'''
+    report = self.report()
+    
+    if path is not None:
+      with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    
+    if logger is not None:
+      logger.info(json.dumps(report))
+    
+    return report
 
-os.environ['KAGGLE_USERNAME'] = "farrokhkarimi"
-os.environ['KAGGLE_KEY'] = "***" # Note: Insert your Kaggle key here
+profiler = Profiler()
 
-!kaggle datasets download -d jessicali9530/celeba-dataset
+def instrumented(name, items=None):
+  '''Decorator timing every call of the function as [name], when the 
+     profiler is enabled. items(args, kwargs, result) returns the number of
+     processed items (e.g. images), for the throughput. Nested calls of the
+     same stage are timed once.
+  '''
+  def decorate(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not profiler.enabled:
+        return function(*args, **kwargs)
+      
+      active = profiler.local.__dict__.setdefault('active', set())
+      
+      if name in active:
+        return function(*args, **kwargs)
+      
+      active.add(name)
+      start = time.perf_counter()
+      
+      try:
+        result = function(*args, **kwargs)
+      finally:
+        active.discard(name)
+      
+      seconds = time.perf_counter() - start
+      profiler.record(name, seconds, items(args, kwargs, result) if items else 0)
+      return result
+    
+    return wrapper
+  
+  return decorate
+
+"""# 1. Dataset
+* Download, unzip and load CelebA dataset
+* Optionally download and extract LFW dataset
+"""
 
 # unzipping and storing to 'celeba-dataset' folder
 
+import shutil
+import tarfile
 import zipfile
 
-def extract(path, folder):
-  zip_ref = zipfile.ZipFile(path, 'r')
-  zip_ref.extractall(folder)
-  zip_ref.close()
+class DatasetMaterializer:
+  '''Extracts zip and tar archives into [folder], incrementally:
+      - members are streamed straight to their final location (flattened, 
+        i.e. without directories, if [flatten] is True),
+      - zip members are extracted in parallel by [workers] threads,
+      - every extracted member is appended to a manifest (name, size, crc), 
+        so that re-runs skip it and interrupted runs resume where they were,
+      - partial files are written aside and renamed when complete.
+     Flattening collisions are resolved deterministically: the first member
+     (by name) keeps the file name, the others get a _1, _2, ... suffix.
+  '''
+  def __init__(self, folder, flatten=False, workers=8):
+    self.folder = folder
+    self.flatten = flatten
+    self.workers = workers
+    self.manifest_path = os.path.join(folder, '.manifest.jsonl')
+    self.manifest = dict()  # (archive, member) -> entry
+    self.lock = threading.Lock()
+    
+    os.makedirs(folder, exist_ok=True)
+    
+    if os.path.exists(self.manifest_path):
+      truncated = False
+      
+      with open(self.manifest_path) as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            truncated = True  # line cut by an interrupted run
+            continue
+          
+          self.manifest[(entry['archive'], entry['name'])] = entry
+      
+      if truncated:
+        with open(self.manifest_path, 'w') as f:
+          f.writelines(json.dumps(entry) + '\n' for entry in self.manifest.values())
+  
+  def sanitize(name):
+    '''Member name as a relative path inside the folder, as zipfile's 
+       extractall does: drive, root, '.' and '..' components are dropped.
+    '''
+    name = name.replace('\\', '/')
+    parts = [part for part in name.split('/') if part not in ('', '.', '..')]
+    parts = [os.path.splitdrive(part)[1] for part in parts]
+    parts = [part for part in parts if part not in ('', '.', '..')]
+    
+    if not parts:
+      raise ValueError(f"DatasetMaterializer.sanitize() => invalid member name `{name}`")
+    
+    return os.path.join(*parts)
+  
+  def destinations(self, names):
+    '''Maps every member name to its (relative) destination path.'''
+    if not self.flatten:
+      return { name: DatasetMaterializer.sanitize(name) for name in names }
+    
+    taken = dict()
+    destinations = dict()
+    
+    for name in sorted(names):
+      base = os.path.basename(DatasetMaterializer.sanitize(name))
+      count = taken.get(base, 0)
+      taken[base] = count + 1
+      
+      if count > 0:
+        stem, ext = os.path.splitext(base)
+        base = f'{stem}_{count}{ext}'
+      
+      destinations[name] = base
+    
+    return destinations
+  
+  def is_done(self, archive, name, size, crc):
+    entry = self.manifest.get((archive, name))
+    
+    if entry is None or entry['size'] != size or entry['crc'] != crc:
+      return False
+    
+    dest = os.path.join(self.folder, entry['dest'])
+    return os.path.exists(dest) and os.path.getsize(dest) == size
+  
+  def write(self, archive, name, size, crc, dest, source):
+    '''Streams the [source] file object to dest, then records it.'''
+    path = os.path.join(self.folder, dest)
+    root = os.path.realpath(self.folder)
+    
+    if os.path.commonpath([root, os.path.realpath(path)]) != root:
+      raise ValueError(f"DatasetMaterializer.write() => `{name}` would be written outside of {self.folder}")
+    
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    
+    with open(path + '.part', 'wb') as f:
+      shutil.copyfileobj(source, f, 1 << 20)
+    
+    os.replace(path + '.part', path)
+    entry = { 'archive': archive, 'name': name, 'size': size, 'crc': crc, 'dest': dest }
+    
+    with self.lock:
+      self.manifest[(archive, name)] = entry
+      
+      with open(self.manifest_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    
+    return path
+  
+  def materialize(self, archive_path, nested=True):
+    '''Extracts the archive (zip or tar), skipping the members already done.
+       With nested, the zip archives found inside are materialized as well.
+       
+       Returns the number of extracted members.
+    '''
+    if zipfile.is_zipfile(archive_path):
+      extracted, paths = self.materialize_zip(archive_path)
+    else:
+      extracted, paths = self.materialize_tar(archive_path)
+    
+    if nested:
+      for path in paths:
+        if path.endswith('.zip'):
+          extracted += self.materialize(path, nested)
+    
+    return extracted
+  
+  def materialize_zip(self, archive_path):
+    archive = os.path.basename(archive_path)
+    local = threading.local()
+    
+    with zipfile.ZipFile(archive_path) as zip_ref:
+      members = [info for info in zip_ref.infolist() if not info.is_dir()]
+    
+    destinations = self.destinations([info.filename for info in members])
+    todo = [info for info in members 
+            if not self.is_done(archive, info.filename, info.file_size, info.CRC)]
+    
+    def extract_member(info):
+      # zip handles can't be shared among threads
+      if not hasattr(local, 'zip_ref'):
+        local.zip_ref = zipfile.ZipFile(archive_path)
+      
+      with local.zip_ref.open(info) as source:
+        return self.write(archive, info.filename, info.file_size, info.CRC,
+                          destinations[info.filename], source)
+    
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      list(executor.map(extract_member, todo))
+    
+    paths = [os.path.join(self.folder, destinations[info.filename]) for info in members]
+    return len(todo), paths
+  
+  def materialize_tar(self, archive_path):
+    archive = os.path.basename(archive_path)
+    extracted = 0
+    
+    # the tar stream is read once, sequentially (it's usually gzipped)
+    with tarfile.open(archive_path, 'r:*') as tar_ref:
+      members = [info for info in tar_ref.getmembers() if info.isfile()]
+      destinations = self.destinations([info.name for info in members])
+      
+      for info in members:
+        # tar has no CRC: the member mtime identifies its version
+        if self.is_done(archive, info.name, info.size, info.mtime):
+          continue
+        
+        with tar_ref.extractfile(info) as source:
+          self.write(archive, info.name, info.size, info.mtime, destinations[info.name], source)
+        
+        extracted += 1
+    
+    paths = [os.path.join(self.folder, destinations[info.name]) for info in members]
+    return extracted, paths
 
 base_folder = 'celeba-dataset'
-extract(base_folder + ".zip", base_folder)
-
-for file in os.listdir(base_folder):
-  name, ext = os.path.splitext(file)
-  if ext == ".zip":
-    extract(os.path.join(base_folder, file), base_folder)
-
-# downloading and extracting LFW dataset
-
 lfw_folder = 'lfw'
+lfw_url = 'http://vis-www.cs.umass.edu/lfw/lfw.tgz'
 
-# download
-wget.download('http://vis-www.cs.umass.edu/lfw/lfw.tgz', 'lfw.tgz')
-
-# extract
-!tar -zxvf lfw.tgz
-
-import shutil
-
-def flatten_directory(root):
-  for folder in os.listdir(root):
-    subdir = os.path.join(root, folder)
-
-    if os.path.isdir(subdir):
-      for item in os.listdir(subdir):
-        src = os.path.join(subdir, item)
-        dst = os.path.join(root, item)
-        shutil.move(src, dst)
-      
-      os.rmdir(subdir)
+def download_celeba(folder=base_folder):
+  '''Downloads CelebA from Kaggle (once) and extracts it into [folder].
+     Kaggle credentials are read from KAGGLE_USERNAME and KAGGLE_KEY (or
+     ~/.kaggle/kaggle.json).
+  '''
+  if not os.path.exists(folder + '.zip'):
+    subprocess.run(['kaggle', 'datasets', 'download', '-d', 'jessicali9530/celeba-dataset'], check=True)
+  
+  DatasetMaterializer(folder).materialize(folder + '.zip')
 
-# remove subdirectories:
-flatten_directory('./lfw')
+def download_lfw(folder=lfw_folder):
+  '''Downloads LFW (once) and extracts it into [folder], without 
+     subdirectories.
+  '''
+  if not os.path.exists('lfw.tgz'):
+    import wget
+    wget.download(lfw_url, 'lfw.tgz')
+  
+  DatasetMaterializer(folder, flatten=True).materialize('lfw.tgz')
 
 # CelebA Class
 
@@ -100,77 +452,342 @@ class CelebA():
     self.features_name = []
     self.__prepare(drop_features)
 
+  partitions = { 'training': 0, 'validation': 1, 'test': 2 }
+  
+  def __load_tables(self):
+    '''Parses the attributes and partition csv files once, caching them as
+       int8 columns in a binary file ('list_attr_celeba.npz') re-read on the
+       next runs, unless the csv files change (or the dataset folder isn't
+       writable).
+       
+       Returns (image_ids, columns, values, partition).
+    '''
+    cache_path = os.path.splitext(self.attributes_path)[0] + '.npz'
+    stats = [os.stat(self.attributes_path), os.stat(self.partition_path)]
+    key = '|'.join(f'{stat.st_size}:{stat.st_mtime_ns}' for stat in stats)
+    
+    if os.path.exists(cache_path):
+      cache = np.load(cache_path)
+      
+      if str(cache['key']) == key:
+        return cache['image_ids'], list(cache['columns']), cache['values'], cache['partition']
+    
+    columns = list(pd.read_csv(self.attributes_path, nrows=0).columns)
+    columns.remove('image_id')
+    dtypes = { name: np.int8 for name in columns }
+    attributes = pd.read_csv(self.attributes_path, dtype=dtypes, index_col='image_id')
+    partition = pd.read_csv(self.partition_path, dtype={ 'partition': np.int8 }, index_col='image_id')
+    
+    image_ids = attributes.index.to_numpy(dtype=str)
+    values = (attributes[columns].to_numpy() > 0).astype(np.int8)  # -1 -> 0
+    partition = partition['partition'].reindex(attributes.index, fill_value=-1).to_numpy(np.int8)
+    
+    try:
+      np.savez(cache_path, key=key, image_ids=image_ids, columns=np.array(columns),
+               values=values, partition=partition)
+    except OSError:
+      pass  # read-only dataset folder: parse the csv files on every run
+    return image_ids, columns, values, partition
+
   def __prepare(self, drop_features):
     '''do some preprocessing before using the data: e.g. feature selection'''
+    image_ids, columns, values, partition = self.__load_tables()
+    
     # attributes:
     if self.selected_features is None:
-      self.attributes = pd.read_csv(self.attributes_path)
-      self.num_features = 40
+      selected = columns
     else:
-      self.num_features = len(self.selected_features)
       self.selected_features = self.selected_features.copy()
-      self.selected_features.append('image_id')
-      self.attributes = pd.read_csv(self.attributes_path)[self.selected_features]
-
+      selected = self.selected_features
+    
     # remove unwanted features:
-    for feature in drop_features:
-      if feature in self.attributes:
-        self.attributes = self.attributes.drop(feature, axis=1)
-        self.num_features -= 1
-      
-    self.attributes.set_index('image_id', inplace=True)
-    self.attributes.replace(to_replace=-1, value=0, inplace=True)
-    self.attributes['image_id'] = list(self.attributes.index)
-  
-    self.features_name = list(self.attributes.columns)[:-1]
+    selected = [name for name in selected if name not in drop_features]
+    self.num_features = len(selected)
+    self.features_name = selected
+    
+    indexes = [columns.index(name) for name in selected]
+    self.attributes = pd.DataFrame(values[:, indexes], columns=selected,
+                                   index=pd.Index(image_ids, name='image_id'))
   
-    # load ideal partitioning:
-    self.partition = pd.read_csv(self.partition_path)
-    self.partition.set_index('image_id', inplace=True)
+    # load ideal partitioning: rows of every partition, computed once
+    self.partition = partition
+    self.partition_rows = dict()
+    
+    for name, code in self.partitions.items():
+      rows = np.flatnonzero(partition == code)
+      
+      # CelebA partitions are contiguous: slices give views, not copies
+      if len(rows) > 0 and rows[-1] - rows[0] + 1 == len(rows):
+        rows = slice(int(rows[0]), int(rows[-1]) + 1)
+      
+      self.partition_rows[name] = rows
   
   def split(self, name='training', drop_zero=False):
-    '''Returns the ['training', 'validation', 'test'] split of the dataset'''
+    '''Returns the ['training', 'validation', 'test'] split of the dataset,
+       indexed by 'image_id'.
+    '''
     # select partition split:
-    if name is 'training':
-      to_drop = self.partition.where(lambda x: x != 0).dropna()
-    elif name is 'validation':
-      to_drop = self.partition.where(lambda x: x != 1).dropna()
-    elif name is 'test':  # test
-      to_drop = self.partition.where(lambda x: x != 2).dropna()
-    else:
+    if name not in self.partition_rows:
       raise ValueError('CelebA.split() => `name` must be one of [training, validation, test]')
-
-    partition = self.partition.drop(index=to_drop.index)
-      
-    # join attributes with selected partition:
-    joint = partition.join(self.attributes, how='inner').drop('partition', axis=1)
+    
+    joint = self.attributes.iloc[self.partition_rows[name]]
 
     if drop_zero is True:
       # select rows with all zeros values
-      return joint.loc[(joint[self.features_name] == 1).any(axis=1)]
+      return joint.loc[joint.to_numpy().any(axis=1)]
     elif 0 <= drop_zero <= 1:
-      zero = joint.loc[(joint[self.features_name] == 0).all(axis=1)]
+      zero = joint.loc[~joint.to_numpy().any(axis=1)]
       zero = zero.sample(frac=drop_zero)
       return joint.drop(index=zero.index)
 
     return joint
 
-# loading dataset (selecting 37 attributes out of 40)
+# CelebA attributes, in the list_attr_celeba.csv order
+CELEBA_FEATURES = [
+  '5_o_Clock_Shadow', 'Arched_Eyebrows', 'Attractive', 'Bags_Under_Eyes', 'Bald', 'Bangs', 
+  'Big_Lips', 'Big_Nose', 'Black_Hair', 'Blond_Hair', 'Blurry', 'Brown_Hair', 'Bushy_Eyebrows', 
+  'Chubby', 'Double_Chin', 'Eyeglasses', 'Goatee', 'Gray_Hair', 'Heavy_Makeup', 'High_Cheekbones', 
+  'Male', 'Mouth_Slightly_Open', 'Mustache', 'Narrow_Eyes', 'No_Beard', 'Oval_Face', 'Pale_Skin', 
+  'Pointy_Nose', 'Receding_Hairline', 'Rosy_Cheeks', 'Sideburns', 'Smiling', 'Straight_Hair', 
+  'Wavy_Hair', 'Wearing_Earrings', 'Wearing_Hat', 'Wearing_Lipstick', 'Wearing_Necklace', 
+  'Wearing_Necktie', 'Young']
 
-celeba = CelebA(drop_features=[
-    'Attractive',
-    'Pale_Skin',
-    'Blurry',])
+# the model predicts 37 attributes out of 40
+DROPPED_FEATURES = ['Attractive', 'Pale_Skin', 'Blurry']
+MODEL_FEATURES = [name for name in CELEBA_FEATURES if name not in DROPPED_FEATURES]
 
 """# 2. Load Model
 * Load the model to infer facial features
 """
 
-# download the model weights from the repository on my GitHub
-!wget https://raw.githubusercontent.com/farrokhkarimi/face_clustering/master/weights-FC37-MobileNetV2-0.92.hdf5
+weights_path = 'weights-FC37-MobileNetV2-0.92.hdf5'
+weights_url = 'https://raw.githubusercontent.com/farrokhkarimi/face_clustering/master/weights-FC37-MobileNetV2-0.92.hdf5'
+
+def download_weights(path=weights_path):
+  '''Downloads the model weights from the repository on my GitHub (once).'''
+  if not os.path.exists(path):
+    import wget
+    wget.download(weights_url, path)
+
+# Prediction cache: avoids re-running the model on already seen images
+
+def file_hash(path, block_size=1 << 20):
+  '''Returns the sha1 hex-digest of the content of the given file.'''
+  sha1 = hashlib.sha1()
+  
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      sha1.update(block)
+  
+  return sha1.hexdigest()
+
+class PredictionCache:
+  '''On-disk cache of the model predictions, with:
+      - predictions: stored as rows of a memory-mapped uint8 array,
+      - index: maps every image (path, size, mtime) to its predictions row.
+     Each model gets its own cache folder, named after its weights hash, so
+     changing the weights never returns stale predictions.
+      - variant: distinguishes other backends of the same weights (e.g. a 
+        quantized model, see InferenceBackend.variant).
+  '''
+  def __init__(self, weights_path, folder='predictions-cache', variant=None):
+    self.weights_hash = file_hash(weights_path)
+    self.folder = os.path.join(folder, self.weights_hash if variant is None else f'{self.weights_hash}-{variant}')
+    self.data_path  = os.path.join(self.folder, 'predictions.bin')
+    self.index_path = os.path.join(self.folder, 'index.csv')
+    self.meta_path  = os.path.join(self.folder, 'meta.json')
+    self.num_features = None
+    self.num_rows = 0
+    self.index = dict()  # path -> (size, mtime, row)
+    
+    os.makedirs(self.folder, exist_ok=True)
+    self.__load()
+  
+  def __load(self):
+    if not os.path.exists(self.meta_path):
+      return
+    
+    with open(self.meta_path) as f:
+      meta = json.load(f)
+    
+    self.num_features = meta['num_features']
+    self.num_rows = meta['num_rows']
+    
+    index = pd.read_csv(self.index_path)
+    index = index[index['row'] < self.num_rows]  # rows of an update interrupted before the meta
+    self.index = dict(zip(index['path'], zip(index['size'], index['mtime'], index['row'])))
+  
+  def __save(self):
+    index = pd.DataFrame([(path, *entry) for path, entry in self.index.items()],
+                         columns=['path', 'size', 'mtime', 'row'])
+    index.to_csv(self.index_path, index=False)
+    
+    with open(self.meta_path, 'w') as f:
+      json.dump({ 'num_features': self.num_features, 'num_rows': self.num_rows }, f)
+  
+  def __len__(self):
+    return len(self.index)
+  
+  def predictions(self):
+    '''Returns all the cached predictions as a read-only memory-mapped array.'''
+    if self.num_rows == 0:
+      return np.zeros((0, self.num_features or 0), dtype=np.uint8)
+    
+    return np.memmap(self.data_path, dtype=np.uint8, mode='r',
+                     shape=(self.num_rows, self.num_features))
+  
+  def lookup(self, paths):
+    '''Looks the given paths up in the cache.
+       An entry is valid only if the image size and mtime didn't change.
+       
+       Returns (hits, rows): the boolean mask of the cached paths, and their 
+       rows in the predictions array (-1 for the missing ones).
+    '''
+    rows = np.full(len(paths), -1, dtype=np.int64)
+    
+    for i, path in enumerate(paths):
+      entry = self.index.get(os.path.abspath(path))
+      
+      if entry is not None:
+        stat = os.stat(path)
+        
+        if (entry[0], entry[1]) == (stat.st_size, stat.st_mtime_ns):
+          rows[i] = entry[2]
+    
+    return rows >= 0, rows
+  
+  def update(self, paths, preds):
+    '''Appends the predictions of the given paths to the cache.'''
+    preds = np.asarray(preds, dtype=np.uint8)
+    
+    if len(paths) == 0:
+      return
+    
+    if self.num_features is None:
+      self.num_features = preds.shape[1]
+    elif self.num_features != preds.shape[1]:
+      raise ValueError("Predictions must have the same number of features of the cache!")
+    
+    # the meta is saved last: bytes past num_rows are left by an interrupted update
+    with open(self.data_path, 'ab') as f:
+      f.truncate(self.num_rows * self.num_features)
+      f.write(np.ascontiguousarray(preds).tobytes())
+    
+    for i, path in enumerate(paths):
+      stat = os.stat(path)
+      self.index[os.path.abspath(path)] = (stat.st_size, stat.st_mtime_ns, self.num_rows + i)
+    
+    self.num_rows += len(paths)
+    self.__save()
+
+# Quantized CPU inference backend (TensorFlow Lite)
+
+def convert_to_tflite(weights_path, quantization='float16', calibration_paths=None, folder='tflite-cache'):
+  '''Converts the Keras model to TensorFlow Lite, once: the converted model
+     is cached in [folder], named after the weights hash and quantization.
+      - quantization: one of 'none', 'float16', 'dynamic' (int8 weights) or
+        'int8' (int8 weights and activations, calibrated on calibration_paths).
+       
+     Returns the path of the .tflite model.
+  '''
+  if quantization not in ('none', 'float16', 'dynamic', 'int8'):
+    raise ValueError("convert_to_tflite() => `quantization` must be one of [none, float16, dynamic, int8]")
+  
+  path = os.path.join(folder, f'{file_hash(weights_path)}-{quantization}.tflite')
+  
+  if os.path.exists(path):
+    return path
+  
+  import tensorflow as tf
+  converter = tf.lite.TFLiteConverter.from_keras_model(keras.models.load_model(weights_path))
+  
+  if quantization != 'none':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  
+  if quantization == 'float16':
+    converter.target_spec.supported_types = [tf.float16]
+  elif quantization == 'int8':
+    if not calibration_paths:
+      raise ValueError("int8 quantization needs some calibration_paths!")
+    
+    def representative_dataset():
+      for _, batch in image_batches(calibration_paths, batch_size=1):
+        yield [batch]
+    
+    converter.representative_dataset = representative_dataset
+  
+  os.makedirs(folder, exist_ok=True)
+  
+  with open(path, 'wb') as f:
+    f.write(converter.convert())
+  
+  return path
+
+class InferenceBackend:
+  '''Runs a TensorFlow Lite model with the same interface used by the 
+     inference functions (predict_on_batch), so it can replace the Keras 
+     model in infere_labels & co.
+  '''
+  def __init__(self, tflite_path, threads=None, variant=None):
+    import tensorflow as tf
+    self.interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=threads)
+    self.input_index  = self.interpreter.get_input_details()[0]['index']
+    self.output_index = self.interpreter.get_output_details()[0]['index']
+    self.batch_size = None
+    self.variant = variant
+  
+  def predict_on_batch(self, batch):
+    if len(batch) != self.batch_size:
+      self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+      self.interpreter.allocate_tensors()
+      self.batch_size = len(batch)
+    
+    self.interpreter.set_tensor(self.input_index, np.ascontiguousarray(batch, dtype=np.float32))
+    self.interpreter.invoke()
+    return self.interpreter.get_tensor(self.output_index).copy()
+
+def load_inference_backend(weights_path, backend='keras', quantization='float16', calibration_paths=None, threads=None):
+  '''Loads the model to use for inference:
+      - 'keras': the Keras model itself,
+      - 'tflite': its (cached) TensorFlow Lite conversion, see convert_to_tflite.
+  '''
+  if backend == 'keras':
+    return keras.models.load_model(weights_path)
+  elif backend == 'tflite':
+    path = convert_to_tflite(weights_path, quantization, calibration_paths)
+    return InferenceBackend(path, threads, variant=f'tflite-{quantization}')
+  
+  raise ValueError("load_inference_backend() => `backend` must be one of [keras, tflite]")
+
+def prediction_drift(reference, model, paths, batch_size=64):
+  '''Measures how much the predictions of [model] drift from the ones of the
+     [reference] model (e.g. the Keras one), on the given validation images.
+     
+     Returns a dict with the max/mean absolute difference of the 
+     probabilities, and the agreement of the 0, 1 labels (overall and per
+     feature).
+  '''
+  max_diff, sum_diff, agree, count = 0.0, 0.0, None, 0
+  
+  for _, batch in image_batches(paths, batch_size):
+    expected = np.asarray(reference.predict_on_batch(batch), dtype=np.float64)
+    preds = np.asarray(model.predict_on_batch(batch), dtype=np.float64)
+    diff = np.abs(expected - preds)
+    
+    max_diff = max(max_diff, diff.max())
+    sum_diff += diff.sum()
+    same = (np.round(expected) == np.round(preds)).sum(axis=0)
+    agree = same if agree is None else agree + same
+    count += len(batch)
+  
+  return { 'max_abs_diff': max_diff, 'mean_abs_diff': sum_diff / agree.size / count,
+           'label_agreement': agree.sum() / agree.size / count, 
+           'feature_agreement': agree / count }
 
-model = keras.models.load_model('weights-FC37-MobileNetV2-0.92.hdf5')
-model.summary()
+# optionally, a (much faster on CPU) quantized version of the model. Keep its 
+# predictions apart from the Keras ones:
+#   model = load_inference_backend(weights_path, backend='tflite', quantization='float16')
+#   prediction_cache = PredictionCache(weights_path, variant=model.variant)
 
 #@title Model Input Image Format
 img_size = 224 #@param ["224", "192"] {type:"raw"}
@@ -188,7 +805,7 @@ TARGET_SIZE = (IMG_H, IMG_W)
 
 # Maps: feature_name -> index, and index -> feature_name
 
-dict_feature_name_to_index = { name: i for i, name in enumerate(celeba.features_name) }
+dict_feature_name_to_index = { name: i for i, name in enumerate(MODEL_FEATURES) }
 dict_index_to_feature_name = { v: k for k, v in dict_feature_name_to_index.items() }
 
 def features_to_indexes(features_name):
@@ -213,92 +830,428 @@ def indexes_to_features(feature_indexes):
   
   return features_name
 
-def image_paths_from_folder(folder, amount=-1):
+def sample_indexes(size, sample, random_state=None):
+  '''Picks [sample] distinct indexes out of range(size), without replacement.
+     It picks the same indexes (and order) of pandas' DataFrame.sample, so
+     sampling before or after building a data-frame gives the same rows.
+  '''
+  if not 0 <= sample <= size:
+    raise ValueError(f"Can't sample {sample} items out of {size}!")
+  
+  if not isinstance(random_state, np.random.RandomState):
+    random_state = np.random.RandomState(random_state)
+  
+  return random_state.choice(size, size=sample, replace=False)
+
+class DirectoryIndex:
+  '''Sorted index of the images in a folder (names, sizes and mtimes).
+      - It's saved next to the folder ('<folder>.index.npz') and rescanned 
+        (with os.scandir) only when the folder mtime changes, i.e. when 
+        images are added, removed or renamed. Where the parent folder isn't 
+        writable, it's kept in memory and rescanned every time.
+      - The order doesn't depend on the filesystem, so taking or sampling 
+        paths from it is reproducible.
+     
+     Supports images with extendsion: '.jpeg', '.jpg' and '.png'
+  '''
+  extensions = ('.jpg', '.jpeg', '.png')
+  
+  def __init__(self, folder):
+    self.folder = folder
+    self.index_path = os.path.normpath(folder) + '.index.npz'
+    self.refresh()
+  
+  def refresh(self):
+    folder_mtime = os.stat(self.folder).st_mtime_ns
+    
+    if os.path.exists(self.index_path):
+      index = np.load(self.index_path)
+      
+      if int(index['folder_mtime']) == folder_mtime:
+        self.names, self.sizes, self.mtimes = index['names'], index['sizes'], index['mtimes']
+        return
+    
+    entries = []
+    
+    with os.scandir(self.folder) as it:
+      for entry in it:
+        if entry.name.endswith(self.extensions) and entry.is_file():
+          stat = entry.stat()
+          entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    
+    entries.sort()
+    self.names  = np.array([name for name, _, _ in entries], dtype=str)
+    self.sizes  = np.array([size for _, size, _ in entries], dtype=np.int64)
+    self.mtimes = np.array([mtime for _, _, mtime in entries], dtype=np.int64)
+    
+    try:
+      np.savez(self.index_path, names=self.names, sizes=self.sizes, mtimes=self.mtimes,
+               folder_mtime=folder_mtime)
+    except OSError:
+      pass  # read-only parent folder: keep the index in memory only
+  
+  def __len__(self):
+    return len(self.names)
+  
+  def paths(self, indexes=None):
+    '''Returns the paths of the images at the given indexes (all by default).'''
+    names = self.names if indexes is None else self.names[indexes]
+    return [os.path.join(self.folder, name) for name in names]
+  
+  def sample(self, amount, random_state=None):
+    '''Returns [amount] random paths, in O(amount) time.'''
+    rng = np.random.default_rng(random_state)
+    return self.paths(rng.choice(len(self), size=amount, replace=False, shuffle=False))
+  
+  def stratified_sample(self, amount, strata, random_state=None):
+    '''Returns about [amount] random paths, taking from every stratum a 
+       share proportional to its size (at least one).
+        - strata: the stratum of every image, in index order (e.g. the 
+          person of LFW images, or the CelebA partition).
+    '''
+    rng = np.random.default_rng(random_state)
+    _, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse.reshape(-1), kind='stable')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    
+    chosen = []
+    for start, count in zip(starts, counts):
+      take = min(count, max(1, int(round(amount * count / len(self)))))
+      chosen.append(order[start + rng.choice(count, size=take, replace=False, shuffle=False)])
+    
+    return self.paths(np.sort(np.concatenate(chosen)))
+
+def image_paths_from_folder(folder, amount=-1, sample=None, random_state=None):
   '''From a given folder returns an array of images' path.
      Set amount > 0 to limit the number of path taken.
+     Set sample > 0 to then randomly pick that many paths, among the taken
+     ones (random_state is the seed, for reproducibility).
   
+     Paths are taken in name order, from the folder's DirectoryIndex.
      Supports images with extendsion: '.jpeg', '.jpg' and '.png'
   '''
   assert(folder is not None)
   
-  paths = []
-  count = 0
+  index = DirectoryIndex(folder)
+  paths = index.paths(slice(0, amount) if amount > 0 else None)
   
-  for file in os.listdir(folder):
-    # select only images
-    if file.endswith('.jpg') or file.endswith('.jpeg') or file.endswith('.png'):
-      paths.append(os.path.join(folder, file))
-      count += 1
-      
-      if count == amount:
-        break
+  if sample is not None:
+    paths = [paths[i] for i in sample_indexes(len(paths), sample, random_state)]
       
   return paths
 
 def load_reshape_img(fname, shape):
-  img = load_img(fname, target_size=shape)
-  x = img_to_array(img) / 255.0
+  img = keras_image.load_img(fname, target_size=shape)
+  x = keras_image.img_to_array(img) / 255.0
   x = x.reshape(x.shape)
   return x
 
-def infere_labels(model, paths):
+# Decode-once image store, shared by inference and visualization
+
+class ImageStore:
+  '''Decodes every image once and produces all the registered views of it:
+     a view is a (w, h) shape and a layout, either:
+      - 'rgb': float32 RGB in [0, 1], as the model input (see load_reshape_img),
+      - 'bgr': uint8 BGR, as OpenCV images (see imread).
+     Views are kept in a thread-safe LRU of at most [budget] bytes, so 
+     inference and montages/eigenfaces of the same images share one decode.
+     The 'rgb' views are only produced when requested, never kept: the model 
+     reads each image once, and they would evict the reused 'bgr' ones.
+  '''
+  pass_through = ('rgb',)
+  
+  def __init__(self, views=(), budget=1 << 30):
+    self.views = list(views)
+    self.budget = budget
+    self.nbytes = 0
+    self.items = OrderedDict()  # (path, shape, layout) -> array
+    self.lock = threading.Lock()
+    self.decodes = 0
+  
+  def make_view(self, img, shape, layout):
+    if layout == 'rgb':
+      # nearest, as keras' load_img
+      img = cv2.resize(img, shape, interpolation=cv2.INTER_NEAREST_EXACT)
+      return cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
+    elif layout == 'bgr':
+      return resize(img, shape)
+    
+    raise ValueError("ImageStore => `layout` must be one of [rgb, bgr]")
+  
+  def put(self, key, view):
+    self.items[key] = view
+    self.nbytes += view.nbytes
+    
+    while self.nbytes > self.budget and len(self.items) > 1:
+      _, old = self.items.popitem(last=False)
+      self.nbytes -= old.nbytes
+  
+  def get(self, path, shape, layout='bgr'):
+    '''Returns the (shape, layout) view of the image at path.'''
+    shape = tuple(shape)
+    key = (path, shape, layout)
+    
+    with self.lock:
+      if key in self.items:
+        self.items.move_to_end(key)
+        
+        if profiler.enabled:
+          profiler.count('image_store.hits')
+        
+        return self.items[key]
+      
+      if (shape, layout) not in self.views:
+        self.views.append((shape, layout))
+    
+    # decode (outside the lock) once, for the requested and the kept views
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    views = { (path, view_shape, view_layout): self.make_view(img, view_shape, view_layout)
+              for view_shape, view_layout in self.views 
+              if view_layout not in self.pass_through or (view_shape, view_layout) == (shape, layout) }
+    
+    if profiler.enabled:
+      profiler.count('image_store.misses')
+    
+    with self.lock:
+      self.decodes += 1
+      
+      for view_key, view in views.items():
+        if view_key not in self.items and view_key[2] not in self.pass_through:
+          self.put(view_key, view)
+    
+    return views[key]
+
+# when set to an ImageStore, inference and Cluster images share its decodes
+image_store = None
+
+def image_batches(paths, batch_size=64, workers=4, prefetch=2):
+  '''Streams the images of the given paths as fixed-size float32 batches.
+      - Images are decoded by [workers] background threads.
+      - At most [prefetch] batches are decoded ahead of the consumer, so
+        memory stays bounded to a few batches whatever the amount of paths.
+
+     Yields (start, batch) tuples, where start is the index of the first
+     path within the batch.
+  '''
+  def load_into(batch, i, path):
+    if image_store is not None:
+      batch[i] = image_store.get(path, (IMG_W, IMG_H), 'rgb')
+    else:
+      batch[i] = load_reshape_img(path, TARGET_SIZE)
+
+  def submit(start):
+    chunk = paths[start:start + batch_size]
+    batch = np.empty((len(chunk),) + IMG_SHAPE, dtype=np.float32)
+    futures = [executor.submit(load_into, batch, i, path) for i, path in enumerate(chunk)]
+    pending.append((start, batch, futures))
+
+  starts = iter(range(0, len(paths), batch_size))
+  pending = deque()
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    for start in islice(starts, prefetch + 1):
+      submit(start)
+
+    while pending:
+      start, batch, futures = pending.popleft()
+
+      for future in futures:
+        future.result()  # re-raises decoding errors
+
+      # keep the decoding threads busy while the batch is consumed
+      for next_start in islice(starts, 1):
+        submit(next_start)
+
+      yield start, batch
+
+def infere_labels_stream(model, paths, batch_size=64, workers=4, prefetch=2):
+  '''Streaming version of [infere_labels]: predicts the features of the
+     images batch by batch, while the next batches are decoded in background.
+
+     Yields (start, preds) tuples, where preds are the 0, 1 integer features
+     of the paths[start:start + len(preds)] images.
+  '''
+  assert(model is not None)
+
+  for start, batch in image_batches(paths, batch_size, workers, prefetch):
+    begin = time.perf_counter()
+    preds = np.asarray(model.predict_on_batch(batch))
+    
+    if profiler.enabled:
+      profiler.record('infere_labels.batch', time.perf_counter() - begin, len(batch))
+    
+    yield start, np.round(preds).astype('int')
+
+@instrumented('infere_labels', items=lambda args, kwargs, result: len(result))
+def infere_labels(model, paths, batch_size=64, workers=4, prefetch=2, verbose=1, cache=None):
   '''Use the given model to predict the images features.
      The images are loaded from the given paths.
+       - Images are streamed in batches of [batch_size], so the peak memory
+         doesn't depend on the amount of paths (see infere_labels_stream).
+       - If a PredictionCache is given, only the images missing from it are
+         decoded and predicted; the new predictions are then cached.
      
      Returns an array of array of features.
   '''
+  if cache is not None:
+    hits, rows = cache.lookup(paths)
+    misses = np.flatnonzero(~hits)
+    missing_paths = [paths[i] for i in misses]
+    
+    if profiler.enabled:
+      profiler.count('prediction_cache.hits', len(paths) - len(misses))
+      profiler.count('prediction_cache.misses', len(misses))
+    
+    if len(missing_paths) > 0:
+      cache.update(missing_paths, infere_labels(model, missing_paths, batch_size,
+                                                workers, prefetch, verbose))
+      hits, rows = cache.lookup(paths)
+    
+    preds = np.zeros((len(paths), cache.num_features or 0), dtype='int')
+    preds[hits] = cache.predictions()[rows[hits]]
+    return preds
+  
   assert(model is not None)
-  # first load images
-  image_batch = []
+  preds = None
+  progbar = keras.utils.Progbar(len(paths)) if verbose else None
   
-  for path in paths:
-    img = load_reshape_img(path, TARGET_SIZE)
-    image_batch.append(img)
+  for start, batch_preds in infere_labels_stream(model, paths, batch_size, workers, prefetch):
+    if preds is None:
+      preds = np.empty((len(paths), batch_preds.shape[1]), dtype=batch_preds.dtype)
     
-  # predict labels: batch_size will handle large amount of images
-  preds = model.predict(np.array(image_batch), batch_size=64, verbose=1)
+    preds[start:start + len(batch_preds)] = batch_preds
+    
+    if progbar is not None:
+      progbar.add(len(batch_preds))
+  
+  if preds is None:
+    return np.zeros((0, 0), dtype='int')
   
-  # convert labels to 0, 1 integers.
-  preds = np.round(preds).astype('int')  
   return preds
 
-def dataframe_from_folder_or_labels(features_name, folder, labels=None, model=None, amount=-1):
+# Multi-process (data-parallel) inference
+
+inference_model = None
+inference_memory = None
+inference_preds = None
+inference_args = None
+
+def inference_init(weights_path, name, shape, batch_size, threads):
+  '''Loads the model once per worker process, and attaches the worker to 
+     the shared predictions array.
+  '''
+  global inference_model, inference_memory, inference_preds, inference_args
+  import tensorflow as tf
+  
+  # one core per worker: processes, not threads, give the parallelism
+  tf.config.threading.set_intra_op_parallelism_threads(1)
+  tf.config.threading.set_inter_op_parallelism_threads(1)
+  
+  inference_model = keras.models.load_model(weights_path)
+  inference_memory = shared_memory.SharedMemory(name=name)
+  inference_preds = np.ndarray(shape, np.uint8, buffer=inference_memory.buf)
+  inference_args = (batch_size, threads)
+
+def inference_task(task):
+  '''Predicts a shard of paths, writing into the shared predictions array.'''
+  start, paths = task
+  batch_size, threads = inference_args
+  
+  for offset, preds in infere_labels_stream(inference_model, paths, batch_size, workers=threads):
+    begin = start + offset
+    inference_preds[begin:begin + len(preds)] = preds
+  
+  return len(paths)
+
+def infere_labels_sharded(weights_path, paths, workers=None, batch_size=64, shard_batches=16,
+                          num_features=None, threads=2):
+  '''Data-parallel version of [infere_labels]: the paths are split in shards 
+     of [shard_batches] batches, predicted by [workers] processes that load
+     the model (from [weights_path]) once. Predictions are written in place,
+     in the paths order, into a shared-memory array.
+       - Shards start at multiples of batch_size, so the model sees the same 
+         batches of the single-process path and the results are identical.
+       - threads: decoding threads of every worker.
+       - num_features: number of model outputs (all the CelebA features by default).
+     
+     The workers are spawned (TensorFlow doesn't support fork), so this must 
+     be called from an importable module.
+     
+     Returns an array of array of features.
+  '''
+  workers = workers or os.cpu_count()
+  num_features = num_features or len(dict_feature_name_to_index)
+  shape = (len(paths), num_features)
+  shard = batch_size * shard_batches
+  tasks = [(start, paths[start:start + shard]) for start in range(0, len(paths), shard)]
+  
+  memory = shared_memory.SharedMemory(create=True, size=max(1, len(paths) * num_features))
+  
+  try:
+    preds = np.ndarray(shape, np.uint8, buffer=memory.buf)
+    init_args = (weights_path, memory.name, shape, batch_size, threads)
+    context = multiprocessing.get_context('spawn')
+    
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, 
+                             initializer=inference_init, initargs=init_args) as executor:
+      for _ in executor.map(inference_task, tasks):
+        pass
+    
+    result = preds.astype('int')
+    del preds
+  finally:
+    memory.close()
+    memory.unlink()
+  
+  return result
+
+@instrumented('dataframe_from_folder_or_labels', items=lambda args, kwargs, result: len(result))
+def dataframe_from_folder_or_labels(features_name, folder, labels=None, model=None, amount=-1, cache=None,
+                                    sample=None, random_state=None, verbose=1):
   '''Organize images and feature-labes in a DataFrame.
        - If labels are given it will take that instead, it uses the model to 
          infere the images's labels.
        - Use amount to limit the number of images (and so predictions)
+       - cache: optional PredictionCache, to skip the already predicted images
+       - sample: randomly keep only that many of the [amount] images, before
+         running the model on them. Same result as df.sample(sample, random_state)
+       - verbose: whether to show the inference progress bar
        
      Returns a pandas data-frame indexed by 'image_path'.
   '''
   paths = image_paths_from_folder(folder, amount)
-  labels = labels or infere_labels(model, paths)
-  indexes = features_to_indexes(features_name)
-  
-  df = pd.DataFrame()
-  df['image_path'] = paths
-  df.set_index('image_path', inplace=True)
   
-  # select features for every image
-  for i, name in enumerate(features_name):
-    column = []
+  if sample is not None:
+    chosen = sample_indexes(len(paths), sample, random_state)
+    paths = [paths[i] for i in chosen]
     
-    for j, features in enumerate(labels):
-      column.append(features[indexes[i]])
-    df[name] = column
+    if labels is not None:
+      labels = np.asarray(labels)[chosen]
   
-  # take features
-  img_features = []
-  for features in labels:
-    features_ = []
-    
-    for i, name in enumerate(features_name):
-      features_.append(features[indexes[i]])
-    img_features.append(features_)
+  if labels is None:
+    labels = infere_labels(model, paths, verbose=verbose, cache=cache)
+  
+  # select the features of every image at once: (images, features) uint8 block
+  indexes = features_to_indexes(features_name)
+  features = np.asarray(labels, dtype=np.uint8)[:, indexes]
+  
+  # one column per feature, all backed by the same block
+  index = pd.Index(paths, name='image_path')
+  return pd.DataFrame(features, index=index, columns=list(features_name))
+
+def dataframe_features(df, features_name=None):
+  '''Returns the (images, features) matrix of a data-frame built by 
+     [dataframe_from_folder_or_labels], without copying it when possible.
+       - features_name: columns to take, all the columns by default.
+  '''
+  if 'features' in df:
+    # frames that store a list of features per row
+    return np.array(df['features'].to_list())
   
-  # set a column with the selected features
-  df['features'] = img_features
+  if features_name is not None:
+    df = df[list(features_name)]
   
-  return df
+  return df.to_numpy()
 
 # attribute selection (we can pick any feature, as an example we select these)
 
@@ -314,35 +1267,6 @@ chosen_features = [
                    'Blond_Hair',
                    'Wearing_Hat']
 
-chose_features_indexes = features_to_indexes(chosen_features)
-
-print(f"selected featrues: {chosen_features}")
-print(f"features indexes: {chose_features_indexes}")
-
-# loading data from CelebA
-# Pick 400 samples sampled from 2000 instances. 
-# Let the model infer the selected features
-
-celeba_df = dataframe_from_folder_or_labels(chosen_features, celeba.images_folder, model=model, amount=2000)
-celeba_df = celeba_df.sample(400, random_state=51)
-
-#celeba_df.head()
-
-# loading data from LFW
-# we do the same as before but for LFW
-
-lfw_df = dataframe_from_folder_or_labels(chosen_features, "lfw",  model=model, amount=500)
-lfw_df = lfw_df.sample(100, random_state=51)
-
-lfw_df.head()
-
-# we merge these data together, also we can use each of them alonely
-
-data_df = celeba_df.append(lfw_df)
-
-# show 10 random samples
-data_df.sample(10)
-
 """# 4. Clustering
 * KMeans
 * Plot clusters
@@ -350,17 +1274,12 @@ data_df.sample(10)
 * Weighted Clustering
 """
 
-from sklearn.cluster import DBSCAN, KMeans, AgglomerativeClustering
-from sklearn.cluster import SpectralClustering, OPTICS, Birch
-from sklearn.metrics import silhouette_score
-from math import sqrt
-
 
 def score(method, features):
   print(f'Score with {n_clusters} clusters is {-method.inertia_}')
   
 def silhouette(features, labels):
-  print(f'silhouette_score: {silhouette_score(features, labels)} for {n_clusters} clusters')
+  print(f'silhouette_score: {sklearn_metrics.silhouette_score(features, labels)} for {n_clusters} clusters')
 
   
 def resize(image, shape):
@@ -374,6 +1293,111 @@ def imread(path, shape=None):
     
   return img
 
+# Thumbnails: reduced decoding, thread-pool and on-disk cache
+
+def imread_reduced(path, shape):
+  '''Like imread, but lets the JPEG decoder downscale the image by 2, 4 or 8
+     while decoding, when it's still at least as big as [shape] (w, h).
+  '''
+  with Image.open(path) as img:
+    width, height = img.size  # reads the header only
+  
+  for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                       (2, cv2.IMREAD_REDUCED_COLOR_2)):
+    if width // factor >= shape[0] and height // factor >= shape[1]:
+      return resize(cv2.imread(path, flag), shape)
+  
+  return imread(path, shape)
+
+class ThumbnailCache:
+  '''Loads images as (w, h) BGR thumbnails:
+      - decoded by a pool of [workers] threads, at reduced resolution,
+      - cached as .png files in [folder] (if given), keyed by image path, 
+        size, mtime and thumbnail shape, so later runs skip the decoding.
+  '''
+  def __init__(self, folder='thumbnails-cache', workers=8):
+    self.folder = folder
+    self.workers = workers
+  
+  def cache_path(self, path, shape):
+    stat = os.stat(path)
+    key = f'{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{shape[0]}x{shape[1]}'
+    key = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(self.folder, key[:2], key + '.png')
+  
+  def decode(self, path, shape):
+    if image_store is not None:
+      return image_store.get(path, shape, 'bgr')
+    
+    return imread_reduced(path, shape)
+  
+  def load(self, path, shape):
+    '''Returns the thumbnail of a single image.'''
+    if self.folder is None:
+      return self.decode(path, shape)
+    
+    cache_path = self.cache_path(path, shape)
+    img = cv2.imread(cache_path, cv2.IMREAD_COLOR) if os.path.exists(cache_path) else None
+    
+    if profiler.enabled:
+      profiler.count('thumbnails.misses' if img is None else 'thumbnails.hits')
+    
+    if img is None:
+      img = self.decode(path, shape)
+      os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+      cv2.imwrite(cache_path, img)
+    
+    return img
+  
+  def load_many(self, paths, shape):
+    '''Returns the thumbnails of the given images (in order), decoded in parallel.'''
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      return list(executor.map(lambda path: self.load(path, shape), paths))
+  
+  def iterate(self, paths, shape, chunk_size=64):
+    '''Yields the thumbnails of the given images (in order), decoding them in
+       parallel [chunk_size] at a time, so that only a chunk is in memory.
+    '''
+    for start in range(0, len(paths), chunk_size):
+      yield from self.load_many(paths[start:start + chunk_size], shape)
+
+# shared by all the Cluster instances
+thumbnails = ThumbnailCache()
+
+def group_labels(labels, num_clusters=None):
+  '''Groups the items by cluster in a single pass (a stable argsort and a
+     bincount of the labels), the noise (-1 labelled) first.
+     
+     Returns (order, offsets): the item indices sorted by cluster, and the 
+     (num_clusters + 2) offsets of every group in [order]; the members of
+     cluster k are order[offsets[k + 1]:offsets[k + 2]], the noise ones
+     order[:offsets[1]].
+  '''
+  labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+  
+  if num_clusters is None:
+    num_clusters = int(labels.max()) + 1 if len(labels) > 0 else 0
+  
+  order = np.argsort(labels, kind='stable')
+  counts = np.bincount(labels + 1, minlength=num_clusters + 1)
+  offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+  np.cumsum(counts, out=offsets[1:])
+  return order, offsets
+
+def segment_sums(values, offsets):
+  '''Sums the rows of [values] within every segment [offsets[i], offsets[i + 1]).
+     Returns a (segments, columns) int64 array, zero for the empty segments.
+  '''
+  values = np.asarray(values).reshape(len(values), -1)
+  sums = np.zeros((len(offsets) - 1, values.shape[1]), dtype=np.int64)
+  sizes = np.diff(offsets)
+  filled = sizes > 0
+  
+  if filled.any():
+    sums[filled] = np.add.reduceat(values, offsets[:-1][filled], axis=0, dtype=np.int64)
+  
+  return sums
+
 def labels_to_indices(labels):
   '''Convert a list of cluster-labels into a dict of indices organized by
      cluster-id, including the noise claster (the one -1 labelled).
@@ -382,15 +1406,198 @@ def labels_to_indices(labels):
        - labels = [0, 1, 1, 0, 2, 2]
        - returns -> { 0: [0, 3], 1: [1, 2], 2: [4, 5] }
   '''
-  indices  = dict()
+  labels = np.asarray(labels).reshape(-1)
+  
+  if len(labels) == 0:
+    return dict()
+  
+  order, offsets = group_labels(labels)
+  return { k - 1: order[offsets[k]:offsets[k + 1]] 
+           for k in range(len(offsets) - 1) if offsets[k + 1] > offsets[k] }
+
+# Bit-packed binary features and Hamming distance
+
+# number of set bits of every 16-bit word
+POPCOUNT_16 = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+def pack_features(features):
+  '''Packs binary (images, features) vectors into uint64 words, 64 features
+     per word: (images, ceil(features / 64)). 
+  '''
+  features = np.asarray(features)
+  bits = np.packbits(features != 0, axis=1)
+  
+  # pad every row to a whole number of 8-bytes words
+  num_words = (features.shape[1] + 63) // 64
+  words = np.zeros((len(features), num_words * 8), dtype=np.uint8)
+  words[:, :bits.shape[1]] = bits
+  return words.view(np.uint64)
+
+def popcount(words):
+  '''Counts the set bits of every uint64 word, through a 16-bit lookup table.'''
+  words = np.ascontiguousarray(words, dtype=np.uint64)
+  counts = POPCOUNT_16[words.view(np.uint16)]
+  return counts.reshape(words.shape + (4,)).sum(axis=-1, dtype=np.uint16)
+
+def hamming_distances(packed_a, packed_b=None, memory_cap=64 << 20, block_size=None):
+  '''Pairwise Hamming distances among packed features (see pack_features):
+     the popcount of the XOR of every pair of rows. Computed a block of rows
+     at a time, so that the temporaries (XOR and popcount, 16 bytes per word
+     of every pair) take at most [memory_cap] bytes; block_size overrides it.
+     
+     Returns an (len(packed_a), len(packed_b)) matrix of distances.
+  '''
+  if packed_b is None:
+    packed_b = packed_a
+  
+  num_words = packed_a.shape[1]
+  dtype = np.uint8 if num_words * 64 <= 255 else np.uint16
+  distances = np.empty((len(packed_a), len(packed_b)), dtype=dtype)
   
-  for cluster_id in set(labels):
-    indices[cluster_id] = []
+  if block_size is None:
+    block_size = max(1, memory_cap // (16 * num_words * max(1, len(packed_b))))
   
-  for i, label in enumerate(labels):
-    indices[label].append(i)
+  for start in range(0, len(packed_a), block_size):
+    block = packed_a[start:start + block_size]
+    xor = block[:, None, :] ^ packed_b[None, :, :]
+    distances[start:start + len(block)] = popcount(xor).sum(axis=-1, dtype=dtype)
   
-  return indices
+  return distances
+
+def hamming_silhouette(packed, labels, memory_cap=256 << 20):
+  '''Silhouette score of the given labels, using the Hamming distance 
+     among the packed features. Computed in blocks (see silhouette_values),
+     the n x n distance matrix is never built.
+  '''
+  return silhouette_values(packed, labels, metric=hamming_distances, memory_cap=memory_cap).mean()
+
+# Scalable silhouette
+
+def silhouette_values(points, labels, rows=None, weights=None, metric='euclidean', memory_cap=256 << 20):
+  '''Exact silhouette values of points[rows] (all points by default).
+     Distances are computed a block of rows at a time, so that a block (the
+     distances and the temporaries of the metric) takes about [memory_cap] 
+     bytes whatever the number of points.
+       - weights: multiplicity of every point, e.g. when points are the 
+         unique rows of a larger set.
+       - metric: any metric of sklearn's pairwise_distances, or a function
+         (a, b, memory_cap) -> distances matrix, whose temporaries take at 
+         most memory_cap bytes (e.g. hamming_distances on packed points).
+  '''
+  labels = np.asarray(labels)
+  rows = np.arange(len(points)) if rows is None else np.asarray(rows)
+  
+  codes, inverse = np.unique(labels, return_inverse=True)
+  inverse = inverse.reshape(-1)
+  num_labels = len(codes)
+  sizes = np.bincount(inverse, weights=weights, minlength=num_labels).astype(np.float64)
+  
+  if not 2 <= num_labels <= sizes.sum() - 1:
+    raise ValueError(f"Number of labels is {num_labels}. Valid values are 2 to n_samples - 1 (inclusive)")
+  
+  # sort points by label, so that per-label sums are contiguous reductions
+  order = np.argsort(inverse, kind='stable')
+  sorted_weights = None if weights is None else np.asarray(weights, dtype=np.float64)[order]
+  starts = np.searchsorted(inverse[order], np.arange(num_labels))
+  
+  # sklearn's metrics take float64 points: converted once, not at every block
+  sorted_points = points[order] if callable(metric) else np.asarray(points[order], dtype=np.float64)
+  positions = np.empty(len(order), dtype=np.int64)
+  positions[order] = np.arange(len(order))
+  
+  # a block takes 16 bytes per (row, point) pair: the float64 distances, and
+  # as much for the metric temporaries (sklearn's, or half of the budget)
+  budget = max(0, memory_cap - sorted_points.nbytes - positions.nbytes)
+  block_size = max(1, budget // (16 * len(points)))
+  values = np.empty(len(rows))
+  
+  for start in range(0, len(rows), block_size):
+    block = rows[start:start + block_size]
+    block_points = sorted_points[positions[block]]
+    
+    if callable(metric):
+      distances = metric(block_points, sorted_points, memory_cap=budget // 2).astype(np.float64)
+    else:
+      distances = sklearn_metrics.pairwise_distances(block_points, sorted_points, metric=metric)
+    
+    if sorted_weights is not None:
+      distances *= sorted_weights
+    
+    # (block, labels) sum of the distances from every label's points
+    sums = np.add.reduceat(distances, starts, axis=1)
+    del distances
+    
+    own = inverse[block]
+    own_sizes = sizes[own] - 1  # a point isn't its own neighbour
+    a = sums[np.arange(len(block)), own] / np.maximum(own_sizes, 1)
+    
+    means = sums / sizes
+    means[np.arange(len(block)), own] = np.inf
+    b = means.min(axis=1)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+      value = (b - a) / np.maximum(a, b)
+    
+    # sklearn's convention: 0 for points alone in their cluster
+    values[start:start + len(block)] = np.where(own_sizes > 0, np.nan_to_num(value), 0)
+  
+  return values
+
+def silhouette_unique(points, labels, metric='euclidean', memory_cap=256 << 20):
+  '''Exact silhouette score computed on the distinct (point, label) pairs 
+     only, each weighted by its multiplicity. Binary features have very few 
+     distinct rows, so the cost doesn't depend on the number of points.
+  '''
+  labels = np.asarray(labels)
+  
+  # the same point may (rarely) get different labels: keep distinct pairs
+  _, point_ids = np.unique(points, axis=0, return_inverse=True)
+  pairs = np.column_stack([point_ids.reshape(-1), labels])
+  _, first, counts = np.unique(pairs, axis=0, return_index=True, return_counts=True)
+  
+  values = silhouette_values(points[first], labels[first], weights=counts, metric=metric, memory_cap=memory_cap)
+  return np.average(values, weights=counts)
+
+def silhouette_estimate(points, labels, sample_size=10000, confidence=0.95, metric='euclidean', 
+                        memory_cap=256 << 20, random_state=None):
+  '''Estimates the silhouette score from a stratified sample: every cluster 
+     contributes a number of points proportional to its size, whose (exact)
+     silhouette values are computed against all the points.
+     
+     Returns (score, low, high): the estimate and its [confidence] interval.
+  '''
+  labels = np.asarray(labels)
+  random_state = np.random.RandomState(random_state)
+  total = len(labels)
+  
+  codes, inverse = np.unique(labels, return_inverse=True)
+  inverse = inverse.reshape(-1)
+  strata = [np.flatnonzero(inverse == i) for i in range(len(codes))]
+  
+  samples = []
+  for stratum in strata:
+    amount = int(round(sample_size * len(stratum) / total))
+    amount = min(len(stratum), max(2, amount))
+    samples.append(random_state.choice(stratum, size=amount, replace=False))
+  
+  values = silhouette_values(points, labels, rows=np.concatenate(samples), metric=metric, 
+                             memory_cap=memory_cap)
+  
+  # stratified mean and variance (with finite population correction)
+  score, variance, start = 0.0, 0.0, 0
+  
+  for stratum, sample in zip(strata, samples):
+    stratum_values = values[start:start + len(sample)]
+    start += len(sample)
+    share = len(stratum) / total
+    score += share * stratum_values.mean()
+    
+    if len(sample) > 1:
+      fpc = 1 - len(sample) / len(stratum)
+      variance += share ** 2 * stratum_values.var(ddof=1) / len(sample) * fpc
+  
+  margin = NormalDist().inv_cdf((1 + confidence) / 2) * sqrt(variance)
+  return score, score - margin, score + margin
 
 # Cluster and Clustering utility class
 
@@ -398,45 +1605,55 @@ class Cluster:
   '''A Single cluster with:
       - k: as cluster identifier,
       - features: of the items inside this cluster,
-      - paths: of the images related to the items in the cluster.
+      - paths: of the images related to the items in the cluster,
+      - indices: optional, rows of the items in the clustered data,
+      - frequencies: optional, precomputed features frequency (see
+        Clustering.build_clusters).
   '''
-  def __init__(self, k, features, paths):
+  def __init__(self, k, features, paths, indices=None, frequencies=None):
     if len(features) != len(paths):
       raise ValueError("Size of [features] and [paths] parameters must be the same!")
     
     self.k = k
     self.features = features
     self.paths = paths
+    self.indices = indices
+    self.frequencies = frequencies
     self.size = len(paths)
     self.image = None
     self.eigenface = None
+    self.eigenfaces = None
   
-  def get_image(self, img_size=200, rows=None, cols=None):
+  @instrumented('Cluster.get_image', items=lambda args, kwargs, result: args[0].size)
+  def get_image(self, img_size=200, rows=None, cols=None, limit=256, random_state=None):
     '''Returns an image that represents all cluster's items.
         - It caches the returned image for later reuse.
         - The returned image is in RGB format.
+        - At most [limit] items are shown: a random sample of them (with 
+          the given random_state), for clusters bigger than that.
+        - Empty clusters get a blank (black) tile.
     '''
     if self.image is not None:
       return self.image
     
+    paths = self.paths
+    
+    if self.size > limit:
+      chosen = np.sort(sample_indexes(self.size, limit, random_state))
+      paths = [paths[i] for i in chosen]
+    
     if (rows is None) or (cols is None):
-      rows = int(sqrt(self.size))
+      rows = max(int(sqrt(len(paths))), 1)
       cols = rows
       
     h, w = img_size, img_size
-    image = np.zeros(shape=(h * rows, h * cols, 3), dtype=np.uint8)
-      
-    k = 0
-    for i in range(rows):
-      r = i * h
-      for j in range(cols):
-        c = j * w
-        img = imread(self.paths[k], shape=(w, h))
-        image[r:r+w, c:c+w] = img
-        
-        k = k + 1
-        if k > self.size:
-          break
+    image = np.zeros(shape=(h * rows, w * cols, 3), dtype=np.uint8)
+    images = thumbnails.load_many(paths[:rows * cols], shape=(w, h))
+      
+    for k, img in enumerate(images):
+      r = (k // cols) * h
+      c = (k % cols) * w
+      image[r:r+h, c:c+w] = img
 
     self.image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     return self.image
@@ -456,40 +1673,89 @@ class Cluster:
     
   def __len__(self):
     return self.size
+  
+  def add(self, features, paths):
+    '''Adds new items (features and image paths) to this cluster.
+       The cached image and eigenface are discarded.
+    '''
+    if len(features) != len(paths):
+      raise ValueError("Size of [features] and [paths] parameters must be the same!")
+    
+    self.features = np.concatenate([np.asarray(self.features).reshape(self.size, -1), features])
+    self.paths = list(self.paths) + list(paths)
+    self.size = len(self.paths)
+    self.indices = None
+    self.frequencies = None
+    self.image = None
+    self.eigenface = None
+    self.eigenfaces = None
       
   def features_frequency(self):
     '''Compute the frequency of every feature according to the items 
        within the cluster.
     '''
-    num = len(self.features[0])
-    frequencies = np.zeros(num)
-      
-    for features in self.features:
-      frequencies += features
-      
-    return np.round(frequencies / self.size, 2)
+    if self.frequencies is not None:
+      return np.round(self.frequencies, 2)
+    
+    frequencies = np.asarray(self.features).sum(axis=0)
+    return np.round(frequencies / max(self.size, 1), 2)
 
+  @instrumented('Cluster.get_eigenface', items=lambda args, kwargs, result: args[0].size)
   def get_eigenface(self, w=200, h=200, components=None):
-    '''Computes the average-face of this Cluster'''
-    if self.eigenface is not None:
+    '''Computes the average-face of this Cluster.
+       Images are decoded and accumulated one at a time, so the memory 
+       doesn't depend on the cluster size (black for an empty cluster).
+        - components: deprecated and ignored, the average-face doesn't 
+          depend on it (see get_eigenfaces for the principal components).
+    '''
+    if self.eigenface is not None and self.eigenface.shape[:2] == (h, w):
       return self.eigenface
     
-    if components is None:
-      components = self.size
+    total = np.zeros((h, w, 3), dtype=np.float64)
+    
+    for img in thumbnails.iterate(self.paths, shape=(w, h)):
+      total += cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    
+    self.eigenface = (total / (255. * max(self.size, 1))).astype(np.float32)
+    return self.eigenface
+  
+  @instrumented('Cluster.get_eigenfaces', items=lambda args, kwargs, result: args[0].size)
+  def get_eigenfaces(self, components=8, w=200, h=200, batch_size=64):
+    '''Computes the top principal components (eigenfaces) of this Cluster's
+       images, through an incremental PCA over batches of [batch_size] 
+       images, in bounded memory.
+       
+       Returns a (components, h, w, 3) array, cached for later reuse.
+    '''
+    components = min(components, self.size)
+    
+    if self.eigenfaces is not None and self.eigenfaces.shape == (components, h, w, 3):
+      return self.eigenfaces
     
-    # load flat images into a matrix
-    data = np.zeros((self.size, h * w * 3), dtype=np.float32)
+    if components == 0:  # empty cluster
+      self.eigenfaces = np.zeros((0, h, w, 3), dtype=np.float32)
+      return self.eigenfaces
     
-    for i in range(self.size):
-      img = imread(self.paths[i], shape=(h, w))
-      img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) / 255.
-      data[i, :] = img.flatten()
+    batch_size = max(batch_size, components)
+    pca = sklearn_decomposition.IncrementalPCA(n_components=components)
+    
+    # split in batches, the last one merged if too small for the PCA
+    starts = list(range(0, self.size, batch_size))
+    
+    if len(starts) > 1 and self.size - starts[-1] < components:
+      starts.pop()
+    
+    for i, start in enumerate(starts):
+      end = starts[i + 1] if i + 1 < len(starts) else self.size
+      batch = np.empty((end - start, h * w * 3), dtype=np.float32)
+      
+      for j, img in enumerate(thumbnails.iterate(self.paths[start:end], shape=(w, h))):
+        batch[j] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).reshape(-1) / 255.
       
-    # get eigen-vectors from the images
-    mean, eigenvectors = cv2.PCACompute(data, mean=None, maxComponents=components)
+      pca.partial_fit(batch)
     
-    self.eigenface = mean.reshape((h, w, 3))
-    return self.eigenface
+    self.eigenfaces = pca.components_.reshape((components, h, w, 3))
+    return self.eigenfaces
   
 
 class Clustering:
@@ -500,62 +1766,436 @@ class Clustering:
     self.features = None
     self.labels = None
     self.num_clusters = None
+    self.packed = None
+    self.tree = None
+    self.features_weights = None
+    self.order = None
+    self.offsets = None
+    self.sizes = None
+    self.frequencies = None
   
-  def fit(self, df, features_weights=None, verbose=False):
-    '''Fits the given dataframe [df] using the given [Method].
-        - The df dataframe must have an 'image_path' and 'features' columns.
-        - The Method can be whatever instance of: KMeans, DBScan, etc.
-        - feature_weights: can be used to give more/less importance to features.
-        
-       Returns an array of k Cluster instances.
+  def precomputed(self):
+    '''Whether the Method expects a precomputed distance matrix (e.g. 
+       DBSCAN, OPTICS or AgglomerativeClustering with metric='precomputed').
+       Such Methods are given the Hamming distances of the packed features.
     '''
-    clusters = []
-    features = df['features'].to_list()
-    features = np.array(features)
-    
-    if features_weights is None:
-      features_weights = np.ones(features.shape, dtype=np.float32)
+    params = self.method.get_params()
+    return 'precomputed' in (params.get('metric'), params.get('affinity'))
+  
+  def fit_features(self, features, features_weights=None, collapse=False):
+    '''Fits the given (images, features) matrix, as done by [fit].
+       Returns the labels of the features.
+    '''
+    precomputed = self.precomputed()
     
     # fit features (viewed as n-dimensional points)
-    result = self.method.fit(features * features_weights)
+    if features_weights is None:
+      points = features
+    elif precomputed:
+      raise ValueError("features_weights can't be used with the Hamming distance!")
+    else:
+      points = features * features_weights
     
-    # get clustering info
-    labels = result.labels_
-    num_clusters = len(set(labels)) - (1 if -1 in labels else 0)
-    noise_amount = list(labels).count(-1)  # count the occurrencies of '-1'
+    if collapse is True:
+      if 'sample_weight' not in inspect.signature(self.method.fit).parameters:
+        raise ValueError(f"{type(self.method).__name__} doesn't support sample_weight, can't collapse!")
+      
+      # fit unique points only, then map labels back to every point
+      unique, inverse, counts = np.unique(points, axis=0, return_inverse=True, return_counts=True)
+      
+      if precomputed:
+        unique = hamming_distances(pack_features(unique))
+      
+      result = self.method.fit(unique, sample_weight=counts)
+      labels = result.labels_[inverse.reshape(-1)]
+    elif precomputed:
+      result = self.method.fit(hamming_distances(pack_features(points)))
+      labels = result.labels_
+    else:
+      result = self.method.fit(points)
+      labels = result.labels_
     
     # save as last fit
     self.result = result
     self.labels = labels
     self.features = features
-    self.num_clusters = num_clusters
+    # a cluster k may be left empty by the Method: there are max + 1 of them
+    self.num_clusters = int(labels.max()) + 1 if len(labels) > 0 else 0
+    self.packed = pack_features(features) if precomputed else None
+    self.features_weights = features_weights
+    return labels
+  
+  def centroids(self):
+    '''Returns the (num_clusters, features) centroids of the last fit: the
+       Method's cluster_centers_ if any, otherwise the mean (weighted) 
+       features of every cluster (NaN for the empty ones).
+    '''
+    if self.result is None:
+      raise ValueError("Fit data before computing the centroids!")
+    
+    centers = getattr(self.result, 'cluster_centers_', None)
+    
+    if centers is not None and len(centers) == self.num_clusters:
+      return np.asarray(centers)
+    
+    points = np.asarray(self.features, dtype=np.float64)
+    
+    if self.features_weights is not None:
+      points = points * self.features_weights
+    
+    labels = np.asarray(self.labels)
+    clustered = labels >= 0  # skip noise
+    sums = np.zeros((self.num_clusters, points.shape[1]))
+    np.add.at(sums, labels[clustered], points[clustered])
+    counts = np.bincount(labels[clustered], minlength=self.num_clusters)
+    
+    with np.errstate(invalid='ignore'):
+      return sums / counts[:, None]
+  
+  def centroid_index(self, features_name, weights_hash=None):
+    '''The CentroidIndex of the last fit, with its centroids, weights and 
+       metric (Hamming for Methods fit on precomputed distances).
+    '''
+    metric = 'hamming' if self.packed is not None else 'euclidean'
+    return CentroidIndex(self.centroids(), features_name, features_weights=self.features_weights,
+                         weights_hash=weights_hash, metric=metric)
+  
+  @instrumented('Clustering.fit', items=lambda args, kwargs, result: len(args[1]))
+  def fit(self, df, features_weights=None, verbose=False, features_name=None, collapse=False):
+    '''Fits the given dataframe [df] using the given [Method].
+        - The df dataframe must be indexed by 'image_path' and have a column 
+          per feature (see dataframe_from_folder_or_labels).
+        - The Method can be whatever instance of: KMeans, DBScan, etc.
+        - feature_weights: can be used to give more/less importance to features.
+        - features_name: the feature columns of df, all the columns by default.
+        - collapse: fit only the distinct feature vectors, weighted by their 
+          number of occurrencies. Binary features have few distinct vectors,
+          so the fit cost doesn't grow with the amount of images. The Method 
+          must support sample_weight (e.g. KMeans, MiniBatchKMeans, DBSCAN).
+        
+       Methods with metric='precomputed' are fit on the Hamming distances of
+       the (binary) features, computed on their bit-packed form.
+        
+       Returns an array of k Cluster instances.
+    '''
+    features = dataframe_features(df, features_name)
+    labels = self.fit_features(features, features_weights, collapse)
+    num_clusters = self.num_clusters
+    noise_amount = int(np.count_nonzero(labels == -1))  # count the occurrencies of '-1'
     
     if verbose is True:
       print(f'Estimated number of clusters: {num_clusters}')
       print(f'Estimated number of noise points: {noise_amount}')
     
-    # for every cluster, get the indexes of the belonging samples
-    indices = labels_to_indices(labels)
+    return self.build_clusters(df)
+  
+  def fit_stream(self, batches, features_path, num_images, indexes=None, features_weights=None):
+    '''Out-of-core version of [fit]: fits the Method incrementally, through
+       partial_fit (e.g. MiniBatchKMeans, Birch), on a stream of batches, so 
+       the features of all the images are never in memory at once.
+        - batches: iterable of (start, preds), e.g. infere_labels_stream(...),
+          the fit then overlaps with the inference.
+        - features_path: .npy file where the (num_images, features) uint8 
+          selected features are spilled, for the labels pass [assign_stream].
+        - indexes: the columns of preds to cluster (see features_to_indexes),
+          all by default.
+       Batches are buffered until they have at least n_clusters rows, as the
+       first partial_fit needs them to initialize the centers. Birch only
+       builds its subclusters while streaming, and runs its global
+       clustering (n_clusters) once, at the end.
+    '''
+    features = None
+    pending = []
+    fitted = False
+    birch = isinstance(self.method, sklearn_cluster.Birch)
+    n_clusters = getattr(self.method, 'n_clusters', None)
+    min_rows = n_clusters if isinstance(n_clusters, int) and not birch else 1
     
-    # build Cluster istances
-    for k in range(num_clusters):
-      # for every cluster k find the corresponding image paths and features
-      df_slice = df.iloc[indices[k]]
-      paths = list(df_slice.index)
-      features = list(df_slice['features'].values)
-
-      clusters.append(Cluster(k, features, paths))
+    def partial_fit():
+      batch = np.concatenate(pending)
+      pending.clear()
+      self.method.partial_fit(batch if features_weights is None else batch * features_weights)
+    
+    # Birch would re-run its global clustering after every batch
+    if birch:
+      self.method.set_params(n_clusters=None)
+    
+    try:
+      for start, preds in batches:
+        preds = np.asarray(preds, dtype=np.uint8)
+        batch = preds if indexes is None else preds[:, indexes]
+        
+        if features is None:
+          features = np.lib.format.open_memmap(features_path, mode='w+', dtype=np.uint8, 
+                                               shape=(num_images, batch.shape[1]))
+        
+        features[start:start + len(batch)] = batch
+        pending.append(batch)
+        
+        if fitted or sum(len(batch) for batch in pending) >= min_rows:
+          partial_fit()
+          fitted = True
+      
+      if features is None:
+        raise ValueError("Clustering.fit_stream() => `batches` is empty")
+      
+      if pending:
+        if not fitted and sum(len(batch) for batch in pending) < min_rows:
+          raise ValueError(f"Clustering.fit_stream() => fewer images than n_clusters ({min_rows})")
+        
+        partial_fit()
+    finally:
+      if birch:
+        self.method.set_params(n_clusters=n_clusters)
+    
+    if birch:
+      self.method.partial_fit()  # global clustering of the subclusters
+    
+    features.flush()
+    self.result = self.method
+    self.features = features
+    self.features_weights = features_weights
+    return self.method
+  
+  def assign_stream(self, labels_path, batch_size=65536, features_weights=None):
+    '''Second pass of [fit_stream]: predicts the label of every image a 
+       batch at a time, reading the spilled features and writing the labels 
+       to the [labels_path] .npy file.
+        - features_weights: the ones given to fit_stream by default.
+       
+       Returns the labels, as a memory-mapped array.
+    '''
+    if self.result is None:
+      raise ValueError("Fit data before assigning labels!")
+    
+    features = self.features
+    labels = np.lib.format.open_memmap(labels_path, mode='w+', dtype=np.int32, shape=(len(features),))
+    
+    if features_weights is None:
+      features_weights = self.features_weights
+    
+    for start in range(0, len(features), batch_size):
+      batch = np.asarray(features[start:start + batch_size])
+      
+      if features_weights is not None:
+        batch = batch * features_weights
+      
+      labels[start:start + len(batch)] = self.method.predict(batch)
+    
+    labels.flush()
+    self.labels = labels
+    self.num_clusters = int(labels.max()) + 1 if len(labels) > 0 else 0
+    return labels
+  
+  def summarize(self):
+    '''Groups the items of the last fit by cluster, in one vectorized pass:
+        - order, offsets: the items sorted by cluster (see group_labels),
+        - sizes: (num_clusters) number of items of every cluster,
+        - frequencies: (num_clusters, features) features frequency of every 
+          cluster, through segment sums over the sorted features.
+       
+       Returns the features sorted by cluster, the noise ones first.
+    '''
+    self.order, self.offsets = group_labels(self.labels, self.num_clusters)
+    sizes = np.diff(self.offsets)
+    
+    features = np.asarray(self.features)[self.order]
+    sums = segment_sums(features, self.offsets)
+    
+    self.sizes = sizes[1:]
+    self.frequencies = sums[1:] / np.maximum(self.sizes, 1)[:, None]
+    return features
+  
+  def build_clusters(self, df):
+    '''Builds a Cluster instance for every cluster of the last fit, taking
+       the image paths from the [df] index.
+       The features, paths and indices of the clusters are views on arrays 
+       shared by all of them (see summarize).
+    '''
+    features = self.summarize()
+    paths = df.index.to_numpy()[self.order]
+    clusters = []
+    
+    for k in range(self.num_clusters):
+      start, end = self.offsets[k + 1], self.offsets[k + 2]
+      clusters.append(Cluster(k, features[start:end], paths[start:end], 
+                              indices=self.order[start:end], frequencies=self.frequencies[k]))
     
     return clusters
   
-  def evaluate(self):
+  def save(self, path, paths, clusters=None, features_name=None):
+    '''Saves the last fit in the [path] folder, as a set of .npy files (plus
+       the pickled, fitted Method and a manifest.json), to be memory-mapped by 
+       [load_clustering] without re-running inference or fit.
+        - paths: the image paths of the fitted items, e.g. df.index.
+        - clusters: the Cluster instances of the fit, their cached montages 
+          and eigenfaces are saved too.
+        - features_name: the names of the features, saved in the manifest.
+       
+       The items are stored grouped by cluster (noise first): a Cluster is
+       a contiguous range of every array, and 'order.npy' maps the items 
+       back to their fitted rows. The bit-packed features of a Hamming fit
+       (see pack_features) are saved too, as 'packed.npy'.
+    '''
+    if self.result is None:
+      raise ValueError("Fit data before saving!")
+    
+    if len(paths) != len(self.labels):
+      raise ValueError("Size of [paths] and of the fitted data must be the same!")
+    
+    features = self.summarize()
+    os.makedirs(path, exist_ok=True)
+    
+    # the manifest is written last: its presence marks a complete save
+    manifest_path = os.path.join(path, 'manifest.json')
+    if os.path.exists(manifest_path):
+      os.remove(manifest_path)
+    
+    arrays = { 'labels': np.asarray(self.labels)[self.order], 'features': features, 
+               'paths': np.asarray(paths, dtype=str)[self.order], 'order': self.order, 
+               'offsets': self.offsets, 'frequencies': self.frequencies }
+    
+    if self.packed is not None:
+      arrays['packed'] = np.asarray(self.packed)[self.order]
+    
+    cached = { cluster.k: cluster for cluster in clusters or [] }
+    for name in ('image', 'eigenface'):
+      images = [getattr(cached[k], name) if k in cached else None for k in range(self.num_clusters)]
+      
+      if any(image is not None for image in images):
+        arrays[f'{name}s'], arrays[f'{name}_offsets'], arrays[f'{name}_shapes'] = pack_images(images)
+    
+    for name, array in arrays.items():
+      np.save(os.path.join(path, f'{name}.npy'), array)
+    
+    with open(os.path.join(path, 'method.pkl'), 'wb') as f:
+      pickle.dump((self.method, self.result), f)  # the same object for sklearn's Methods
+    
+    weights = [] if self.features_weights is None else np.asarray(self.features_weights).tolist()
+    manifest = { 'version': 1, 'method': type(self.method).__name__, 'num_clusters': self.num_clusters,
+                 'items': len(self.labels), 'features_name': list(features_name or []), 
+                 'features_weights': weights, 'arrays': sorted(arrays) }
+    
+    with open(manifest_path, 'w') as f:
+      json.dump(manifest, f, indent=2)
+  
+  def build_tree(self, df, method=None, metric=None, features_name=None, path=None):
+    '''Computes the hierarchical (agglomerative) merge tree of [df] once, so 
+       that it can be cut at any number of clusters by [cut_tree].
+        - method, metric: linkage method and distance (see scipy's linkage),
+          by default the linkage and metric of the Method if it's an 
+          AgglomerativeClustering ('precomputed' meaning Hamming, as in 
+          [fit]), otherwise 'ward' and 'euclidean'. metric='hamming' 
+          evaluates clusterings with the Hamming distance; 'ward' only 
+          works with the Euclidean one.
+        - path: optional .npz file caching the tree on disk, it's reused if 
+          it was built from the same features, method and metric.
+       
+       Returns the linkage matrix of the tree.
+    '''
+    params = dict()
+    
+    if isinstance(self.method, sklearn_cluster.AgglomerativeClustering):
+      params = self.method.get_params()
+    
+    if method is None:
+      method = params.get('linkage', 'ward')
+    
+    if metric is None:
+      metric = params.get('metric') or params.get('affinity') or 'euclidean'
+      metric = { 'precomputed': 'hamming', 'l2': 'euclidean', 'l1': 'cityblock', 
+                 'manhattan': 'cityblock' }.get(metric, metric)
+    
+    if method == 'ward' and metric != 'euclidean':
+      raise ValueError(f"Clustering.build_tree() => the ward linkage needs the euclidean metric, not `{metric}`")
+    
+    features = dataframe_features(df, features_name)
+    key = f"{method}-{metric}-{features.shape}-{hashlib.sha1(np.ascontiguousarray(features)).hexdigest()}"
+    tree = None
+    
+    if path is not None and os.path.exists(path):
+      cached = np.load(path)
+      
+      if str(cached['key']) == key:
+        tree = cached['tree']
+    
+    if tree is None:
+      tree = hierarchy.linkage(features, method=method, metric=metric)
+      
+      if path is not None:
+        np.savez(path, tree=tree, key=key)
+    
+    self.tree = tree
+    self.features = features
+    self.packed = pack_features(features) if metric == 'hamming' else None
+    
+    # the tree is fit unweighted, and has no labels until it's cut
+    self.features_weights = None
+    self.labels = None
+    self.num_clusters = None
+    self.order = self.offsets = self.sizes = self.frequencies = None
+    return tree
+  
+  def cut_tree(self, df, k=None, distance=None):
+    '''Cuts the tree computed by [build_tree], either into (at most) [k] 
+       clusters or at the given merge [distance]. It doesn't recompute any 
+       linkage, so trying many cluster counts is instant.
+       
+       Returns an array of Cluster instances.
+    '''
+    if self.tree is None:
+      raise ValueError("Build the tree before cutting it!")
+    
+    if k is not None:
+      labels = hierarchy.fcluster(self.tree, t=k, criterion='maxclust')
+    elif distance is not None:
+      labels = hierarchy.fcluster(self.tree, t=distance, criterion='distance')
+    else:
+      raise ValueError("Clustering.cut_tree() => either `k` or `distance` must be given")
+    
+    # save as last fit (fcluster labels start from 1)
+    self.result = self.tree
+    self.labels = labels - 1
+    self.num_clusters = int(labels.max()) if len(labels) > 0 else 0
+    
+    return self.build_clusters(df)
+  
+  @instrumented('Clustering.evaluate', items=lambda args, kwargs, result: len(args[0].labels))
+  def evaluate(self, mode='full', sample_size=10000, confidence=0.95, memory_cap=256 << 20, random_state=None):
     '''Evaluate the lastly done clustering. 
-       It returns the silhouette_score og the clustering
+       It returns the silhouette_score og the clustering (with the Hamming
+       distance, for Methods fit on precomputed distances)
+        - mode: how to compute the score, one of:
+            - 'full': sklearn's silhouette_score, on all the points (computed
+              as 'chunked' for the Hamming distance),
+            - 'chunked': exact, computed in blocks of at most [memory_cap] bytes,
+            - 'unique': exact, computed on the distinct rows only (fast for 
+              binary features),
+            - 'sample': stratified estimate on about [sample_size] points, 
+              returns (score, low, high) with the [confidence] interval.
     '''
     if self.result is None:
       raise ValueError("Fit data before evaluation!")
+    
+    if self.packed is not None:
+      points, metric = self.packed, hamming_distances
+    else:
+      points, metric = self.features, 'euclidean'
+    
+    if mode == 'full':
+      if self.packed is not None:
+        return hamming_silhouette(self.packed, self.labels, memory_cap)
       
-    return silhouette_score(self.features, self.labels)
+      return sklearn_metrics.silhouette_score(self.features, self.labels)
+    elif mode == 'chunked':
+      return silhouette_values(points, self.labels, metric=metric, memory_cap=memory_cap).mean()
+    elif mode == 'unique':
+      return silhouette_unique(points, self.labels, metric=metric, memory_cap=memory_cap)
+    elif mode == 'sample':
+      return silhouette_estimate(points, self.labels, sample_size, confidence, metric=metric,
+                                 memory_cap=memory_cap, random_state=random_state)
+    else:
+      raise ValueError("Clustering.evaluate() => `mode` must be one of [full, chunked, unique, sample]")
   
   def plot(clusters, rows, cols, dpi=100):
     '''Shows the given clusters.
@@ -677,18 +2317,529 @@ class Clustering:
       k += 3
       
     _ = plt.show()
+  
+  def render_report(clusters, feature_names=None, folder='report', workers=None, img_size=200, dpi=100):
+    '''Headless alternative to the plot functions: renders the montage, the
+       eigenface and the features frequency chart of every cluster as 
+       separate PNG files in [folder], in parallel on [workers] processes 
+       (one cluster at a time per process, so the memory stays bounded), 
+       and an index.html that shows them.
+        - feature_names: the features of the clusters, no frequency charts 
+          if None.
+        - img_size: size of a montage tile and of the eigenface.
+        - dpi: resolution of the frequency charts.
+       
+       Returns the path of index.html.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    tasks = [(cluster, feature_names, folder, img_size, dpi) for cluster in clusters]
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      files = list(executor.map(render_task, tasks))
+    
+    rows = []
+    for cluster, names in zip(clusters, files):
+      cells = ''.join(f'<td><img src="{name}"></td>' for name in names)
+      rows.append(f'<tr><th>Cluster {cluster.k}<br>{cluster.size} images</th>{cells}</tr>')
+    
+    path = os.path.join(folder, 'index.html')
+    
+    with open(path, 'w') as f:
+      f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Clusters</title></head><body>\n')
+      f.write(f'<h1>{len(clusters)} clusters</h1>\n<table>\n')
+      f.write('\n'.join(rows))
+      f.write('\n</table>\n</body></html>\n')
+    
+    return path
+
+  def sweep(df, grid, workers=None, features_name=None, collapse=False, evaluate_mode='full', **evaluate_args):
+    '''Fits every combination of Method and parameters of the given grid, 
+       in parallel on [workers] processes, and scores them.
+        - grid: dict of Method class -> dict of parameter -> list of values,
+          e.g. { KMeans: { 'n_clusters': range(2, 65) },
+                 DBSCAN: { 'eps': [0.5, 1.0], 'min_samples': [5, 10] } }
+        - The features are shared (read-only) among the processes, through
+          shared memory, instead of being pickled for every fit.
+        - collapse, evaluate_mode and evaluate_args: as in [fit] and [evaluate].
+       
+       Returns a data-frame with a row per fit, ranked by score.
+    '''
+    features = np.ascontiguousarray(dataframe_features(df, features_name))
+    tasks = [(Method, params, collapse, evaluate_mode, evaluate_args)
+             for Method, param_grid in grid.items() for params in sklearn_selection.ParameterGrid(param_grid)]
+    
+    memory = shared_memory.SharedMemory(create=True, size=max(1, features.nbytes))
+    
+    try:
+      np.ndarray(features.shape, features.dtype, buffer=memory.buf)[:] = features
+      init_args = (memory.name, features.shape, features.dtype.str)
+      
+      with ProcessPoolExecutor(max_workers=workers, initializer=sweep_init, initargs=init_args) as executor:
+        rows = list(executor.map(sweep_task, tasks))
+    finally:
+      memory.close()
+      memory.unlink()
+    
+    table = pd.DataFrame(rows)
+    return table.sort_values('score', ascending=False, na_position='last').reset_index(drop=True)
+
+# Parallel hyperparameter sweep (see Clustering.sweep)
+
+sweep_memory = None
+sweep_features = None
+
+def sweep_init(name, shape, dtype):
+  '''Attaches a sweep worker process to the shared features.'''
+  global sweep_memory, sweep_features
+  sweep_memory = shared_memory.SharedMemory(name=name)
+  sweep_features = np.ndarray(shape, np.dtype(dtype), buffer=sweep_memory.buf)
+  sweep_features.setflags(write=False)
+
+def sweep_task(task):
+  '''Fits and evaluates a single Method of the sweep grid.'''
+  Method, params, collapse, evaluate_mode, evaluate_args = task
+  clustering = Clustering(Method(**params))
+  
+  start = time.perf_counter()
+  labels = clustering.fit_features(sweep_features, collapse=collapse)
+  fit_time = time.perf_counter() - start
+  
+  try:
+    score = clustering.evaluate(evaluate_mode, **evaluate_args)
+    score = score[0] if evaluate_mode == 'sample' else score
+  except ValueError:
+    score = np.nan  # e.g. a single cluster found
+  
+  return { 'method': Method.__name__, 'params': params, 'num_clusters': clustering.num_clusters,
+           'noise': int(np.count_nonzero(labels == -1)), 'score': score, 
+           'fit_time': fit_time, 'total_time': time.perf_counter() - start }
+
+# Saved clusterings (see Clustering.save)
+
+def pack_images(images):
+  '''Packs images of any shape (None for the missing ones) into a flat 
+     array, with the (len(images) + 1) offsets and the shapes of every one.
+  '''
+  present = [image for image in images if image is not None]
+  dtype = np.result_type(*present) if present else np.uint8
+  shapes = np.zeros((len(images), 3), dtype=np.int64)
+  
+  for i, image in enumerate(images):
+    if image is not None:
+      shapes[i, :image.ndim] = image.shape
+  
+  offsets = np.zeros(len(images) + 1, dtype=np.int64)
+  np.cumsum(shapes.prod(axis=1), out=offsets[1:])
+  
+  data = np.empty(offsets[-1], dtype=dtype)
+  for i, image in enumerate(images):
+    if image is not None:
+      data[offsets[i]:offsets[i + 1]] = np.asarray(image).reshape(-1)
+  
+  return data, offsets, shapes
+
+def unpack_image(data, offsets, shapes, i):
+  '''The i-th image packed by pack_images (a view of [data]), or None.'''
+  if offsets[i + 1] == offsets[i]:
+    return None
+  
+  shape = tuple(int(n) for n in shapes[i] if n > 0)
+  return data[offsets[i]:offsets[i + 1]].reshape(shape)
+
+def load_clustering(path, mmap_mode='r'):
+  '''Loads a clustering saved by Clustering.save. The arrays are memory-mapped
+     (mmap_mode=None reads them in memory instead), so opening even a big
+     clustering is instant and the Clusters are views on the mapped files.
+     
+     Returns (clustering, clusters, features_name): the Clustering holds the 
+     items grouped by cluster, as saved (see Clustering.save).
+  '''
+  manifest_path = os.path.join(path, 'manifest.json')
+  
+  if not os.path.exists(manifest_path):
+    raise ValueError(f"load_clustering() => `{path}` isn't a (complete) saved clustering!")
+  
+  with open(manifest_path) as f:
+    manifest = json.load(f)
+  
+  arrays = { name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) 
+             for name in manifest['arrays'] }
+  
+  with open(os.path.join(path, 'method.pkl'), 'rb') as f:
+    method, result = pickle.load(f)
+  
+  clustering = Clustering(method)
+  clustering.result = result
+  clustering.labels = arrays['labels']
+  clustering.features = arrays['features']
+  clustering.num_clusters = manifest['num_clusters']
+  clustering.order = arrays['order']
+  clustering.offsets = arrays['offsets']
+  clustering.sizes = np.diff(clustering.offsets)[1:]
+  clustering.frequencies = arrays['frequencies']
+  
+  if manifest['features_weights']:
+    clustering.features_weights = np.asarray(manifest['features_weights'])
+  
+  if 'packed' in arrays:
+    clustering.packed = arrays['packed']
+  elif clustering.precomputed():
+    clustering.packed = pack_features(clustering.features)
+  
+  clusters = []
+  
+  for k in range(clustering.num_clusters):
+    start, end = clustering.offsets[k + 1], clustering.offsets[k + 2]
+    cluster = Cluster(k, clustering.features[start:end], arrays['paths'][start:end],
+                      indices=clustering.order[start:end], frequencies=clustering.frequencies[k])
+    
+    for name in ('image', 'eigenface'):
+      if f'{name}s' in arrays:
+        packed = arrays[f'{name}s'], arrays[f'{name}_offsets'], arrays[f'{name}_shapes']
+        setattr(cluster, name, unpack_image(*packed, k))
+    
+    clusters.append(cluster)
+  
+  return clustering, clusters, manifest['features_name']
+
+# Headless report rendering (see Clustering.render_report)
+
+def render_frequencies(freqs, feature_names, path, dpi=100):
+  '''Writes the features frequency bar chart to [path], on a figure of 
+     its own (Agg canvas, no pyplot, no display needed).
+  '''
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  
+  figure = Figure(figsize=(5, 1 + 0.25 * len(feature_names)), dpi=dpi)
+  FigureCanvasAgg(figure)
+  
+  ax = figure.add_subplot()
+  ax.barh(feature_names, freqs, align='center')
+  ax.set_xlim(0, 1)
+  ax.set_xlabel('Frequencies')
+  ax.grid(False)
+  
+  figure.tight_layout()
+  figure.savefig(path)
+
+def render_task(task):
+  '''Renders the images of a single cluster of the report.
+     Returns their file names, relative to the report folder.
+  '''
+  cluster, feature_names, folder, img_size, dpi = task
+  names = [f'cluster-{cluster.k:04d}.png', f'eigenface-{cluster.k:04d}.png']
+  
+  image = cluster.get_image(img_size=img_size)
+  cv2.imwrite(os.path.join(folder, names[0]), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+  
+  eigenface = (cluster.get_eigenface(img_size, img_size) * 255).round().astype(np.uint8)
+  cv2.imwrite(os.path.join(folder, names[1]), cv2.cvtColor(eigenface, cv2.COLOR_RGB2BGR))
+  
+  if feature_names is not None:
+    names.append(f'frequencies-{cluster.k:04d}.png')
+    render_frequencies(cluster.features_frequency(), feature_names, os.path.join(folder, names[2]), dpi)
+  
+  return names
+
+# Online assignment of new images to a saved clustering
+
+class CentroidIndex:
+  '''A fitted clustering reduced to what is needed to assign new images:
+      - centroids: (k, features) representative of every cluster,
+      - features_name: the features the clustering was fit on,
+      - features_weights: the weights used by the fit (if any),
+      - weights_hash: hash of the model weights that inferred the features,
+      - metric: the distance of the clustering, 'euclidean' or 'hamming' (for
+        Methods fit on precomputed distances, see Clustering.precomputed); 
+        with 'hamming', images go to the nearest binarized centroid (the 
+        majority value of every feature in the cluster).
+     See Clustering.centroid_index.
+  '''
+  def __init__(self, centroids, features_name, features_weights=None, weights_hash=None, metric='euclidean'):
+    if metric not in ('euclidean', 'hamming'):
+      raise ValueError("CentroidIndex() => `metric` must be one of [euclidean, hamming]")
+    
+    self.centroids = np.asarray(centroids, dtype=np.float64)
+    self.features_name = list(features_name)
+    self.features_weights = features_weights
+    self.weights_hash = weights_hash
+    self.metric = metric
+    
+    # empty clusters (NaN centroids) are never the nearest
+    self.empty = np.isnan(self.centroids).any(axis=1)
+    self.points = np.where(self.empty[:, None], 0, self.centroids)
+    self.norms = np.where(self.empty, np.inf, (self.points ** 2).sum(axis=1))
+    self.packed = pack_features(self.points >= 0.5) if metric == 'hamming' else None
+  
+  def save(self, path):
+    '''Saves the index to the given .npz file (see load_centroid_index).'''
+    weights = np.asarray([] if self.features_weights is None else self.features_weights)
+    np.savez(path, centroids=self.centroids, features_name=np.asarray(self.features_name),
+             features_weights=weights, weights_hash=np.asarray(self.weights_hash or ''),
+             metric=np.asarray(self.metric))
+  
+  def assign(self, features, batch_size=4096):
+    '''Assigns every row of [features] to its nearest centroid, a batch at 
+       a time: |x - c|^2 = |x|^2 - 2 x.c + |c|^2 as a single matrix product
+       (or the Hamming distances of the packed rows, see metric).
+       
+       Returns the labels of the rows.
+    '''
+    labels = np.empty(len(features), dtype=np.int32)
+    
+    for start in range(0, len(features), batch_size):
+      points = np.asarray(features[start:start + batch_size], dtype=np.float64)
+      
+      if self.metric == 'hamming':
+        distances = np.where(self.empty, np.inf, hamming_distances(pack_features(points), self.packed))
+      else:
+        if self.features_weights is not None:
+          points = points * self.features_weights
+        
+        # |x|^2 is the same for every centroid: not needed for the argmin
+        distances = self.norms - 2 * points @ self.points.T
+      
+      labels[start:start + len(points)] = distances.argmin(axis=1)
+    
+    return labels
+  
+  def assign_images(self, model, paths, clusters=None, cache=None, weights_path=None):
+    '''Infers the features of the given images only, and assigns them to the
+       nearest cluster. 
+        - clusters: the Cluster instances of the clustering (as returned by
+          Clustering.fit), the images are added to them in place. Only the
+          Clusters are updated: the Clustering they come from (its labels, 
+          features and summaries) is not, so Clustering.save doesn't 
+          include the assigned images.
+        - cache, weights_path: used to check that the features are inferred 
+          by the same model of the clustering.
+       
+       Returns the labels of the images.
+    '''
+    if cache is not None:
+      weights_hash = cache.weights_hash
+    elif weights_path is not None:
+      weights_hash = file_hash(weights_path)
+    else:
+      weights_hash = None
+    
+    if self.weights_hash and weights_hash and weights_hash != self.weights_hash:
+      raise ValueError("The model differs from the one used for the clustering!")
+    
+    preds = infere_labels(model, paths, verbose=0, cache=cache)
+    features = np.asarray(preds, dtype=np.uint8)[:, features_to_indexes(self.features_name)]
+    labels = self.assign(features)
+    
+    if clusters is not None:
+      clusters = { cluster.k: cluster for cluster in clusters }
+      
+      for k in np.unique(labels):
+        members = np.flatnonzero(labels == k)
+        clusters[k].add(features[members], [paths[i] for i in members])
+    
+    return labels
+
+def load_centroid_index(path):
+  '''Loads a CentroidIndex saved by CentroidIndex.save'''
+  data = np.load(path)
+  weights = data['features_weights']
+  return CentroidIndex(data['centroids'], data['features_name'].tolist(),
+                       features_weights=weights if weights.size > 0 else None,
+                       weights_hash=str(data['weights_hash']) or None,
+                       metric=str(data['metric']) if 'metric' in data else 'euclidean')
+
+# The original notebook flow, as a function
+
+def run_example(num_clusters=16, random_state=51, sweep=False):
+  '''The notebook example: infers the chosen features of 400 CelebA images 
+     (sampled out of 2000) and 100 LFW images (out of 500), clusters them with
+     KMeans and plots the clusters.
+      - sweep: also sweeps the number of clusters (31 more KMeans fits).
+     
+     Returns the data-frame, the Clustering, its clusters and the sweep 
+     (None unless [sweep]).
+  '''
+  global image_store
+  
+  download_celeba()
+  download_lfw()
+  download_weights()
+  
+  celeba = CelebA(drop_features=DROPPED_FEATURES)
+  model = keras.models.load_model(weights_path)
+  prediction_cache = PredictionCache(weights_path)
+  
+  print(f"selected featrues: {chosen_features}")
+  print(f"features indexes: {features_to_indexes(chosen_features)}")
+  
+  # decode every image once, both for the model input and the cluster montages
+  image_store = ImageStore(views=[((IMG_W, IMG_H), 'rgb'), ((200, 200), 'bgr')])
+  
+  # let the model infer the selected features (of the sampled images only)
+  celeba_df = dataframe_from_folder_or_labels(chosen_features, celeba.images_folder, model=model, amount=2000,
+                                              cache=prediction_cache, sample=400, random_state=random_state)
+  lfw_df = dataframe_from_folder_or_labels(chosen_features, lfw_folder, model=model, amount=500,
+                                           cache=prediction_cache, sample=100, random_state=random_state)
+  
+  # we merge these data together, also we can use each of them alonely
+  data_df = pd.concat([celeba_df, lfw_df])
+  
+  kmeans = Clustering(sklearn_cluster.KMeans(n_clusters=num_clusters))
+  clusters = kmeans.fit(data_df, verbose=True)
+  
+  # prints the goodness of the clustering (values close to 1 are better)
+  print(f"Clustering score: {kmeans.evaluate()}")
+  
+  Clustering.plot(clusters, rows=4, cols=4, dpi=70)
+  
+  # save the clustering, to assign new images without re-clustering
+  centroid_index = kmeans.centroid_index(chosen_features, weights_hash=prediction_cache.weights_hash)
+  centroid_index.save('kmeans-centroids.npz')
+  
+  # sweep the number of clusters, ranked by silhouette score
+  if sweep:
+    sweep = Clustering.sweep(data_df, { sklearn_cluster.KMeans: { 'n_clusters': range(2, 33) } })
+  else:
+    sweep = None
+  
+  return data_df, kmeans, clusters, sweep
+
+"""# 5. Command line
+* download: datasets and model weights
+* infer: features of image folders, to a .npz file
+* cluster: a features file, to a saved clustering (see load_clustering)
+* render: montages, eigenfaces and frequencies of a clustering, as an HTML report
+"""
 
-#@title Clustering Parameters
-num_clusters = 16 #@param {type:"integer"}
+def clustering_method(name, num_clusters=16, eps=1.5, min_samples=5, random_state=None):
+  '''Instantiates the clustering method with the given (command line) name.'''
+  methods = {
+    'kmeans': lambda: sklearn_cluster.KMeans(n_clusters=num_clusters, random_state=random_state),
+    'minibatch': lambda: sklearn_cluster.MiniBatchKMeans(n_clusters=num_clusters, random_state=random_state),
+    'birch': lambda: sklearn_cluster.Birch(n_clusters=num_clusters),
+    'agglomerative': lambda: sklearn_cluster.AgglomerativeClustering(n_clusters=num_clusters),
+    'spectral': lambda: sklearn_cluster.SpectralClustering(n_clusters=num_clusters, random_state=random_state),
+    'dbscan': lambda: sklearn_cluster.DBSCAN(eps=eps, min_samples=min_samples),
+    'optics': lambda: sklearn_cluster.OPTICS(min_samples=min_samples),
+  }
+  
+  if name not in methods:
+    raise ValueError(f"clustering_method() => `name` must be one of {list(methods)}")
+  
+  return methods[name]()
+
+def command_download(args):
+  downloads = { 'celeba': download_celeba, 'lfw': download_lfw, 'weights': download_weights }
+  
+  for name in args.what:
+    downloads[name]()
 
-# KMeans
-kmeans = KMeans(n_clusters=num_clusters)
-kmeans = Clustering(kmeans)
+def command_infer(args):
+  variant = None if args.backend == 'keras' else f'{args.backend}-{args.quantization}'
+  cache = PredictionCache(args.weights, folder=args.cache_dir, variant=variant)
+  paths = []
+  
+  for folder in args.folders:
+    paths += image_paths_from_folder(folder, amount=args.amount, sample=args.sample, random_state=args.seed)
+  
+  # the model is loaded only if some predictions are not cached yet
+  hits, _ = cache.lookup(paths)
+  model = None
+  
+  if not hits.all():
+    calibration_paths = None
+    
+    if args.calibration is not None:
+      calibration_paths = image_paths_from_folder(args.calibration, amount=args.calibration_amount)
+    
+    model = load_inference_backend(args.weights, backend=args.backend, quantization=args.quantization,
+                                   calibration_paths=calibration_paths)
+  
+  preds = infere_labels(model, paths, batch_size=args.batch_size, cache=cache)
+  features = np.asarray(preds, dtype=np.uint8)[:, features_to_indexes(args.features)]
+  
+  np.savez(args.output, paths=np.asarray(paths), features=features, features_name=np.asarray(args.features))
+  print(f"{len(paths)} images => {args.output}")
 
-clusters = kmeans.fit(data_df, verbose=True)
+def command_cluster(args):
+  data = np.load(args.features)
+  features_name = data['features_name'].tolist()
+  df = pd.DataFrame(data['features'], index=pd.Index(data['paths'], name='image_path'), columns=features_name)
+  
+  method = clustering_method(args.method, args.clusters, args.eps, args.min_samples, args.seed)
+  clustering = Clustering(method)
+  clustering.fit(df, verbose=True, collapse=args.collapse)
+  
+  if args.evaluate:
+    print(f"Clustering score: {clustering.evaluate(mode=args.evaluate)}")
+  
+  clustering.save(args.output, data['paths'], features_name=features_name)
+  print(f"{clustering.num_clusters} clusters => {args.output}")
 
-# prints the goodness of the clustering (values close to 1 are better)
-print(f"Clustering score: {kmeans.evaluate()}")
+def command_render(args):
+  _, clusters, features_name = load_clustering(args.clustering)
+  clusters = [cluster for cluster in clusters if cluster.size > 0]
+  
+  index_path = Clustering.render_report(clusters, features_name, folder=args.output_dir,
+                                        workers=args.workers, img_size=args.img_size, dpi=args.dpi)
+  print(f"{len(clusters)} clusters => {index_path}")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Face clustering on inferred facial attributes.')
+  parser.add_argument('--profile', default=None, help='writes the per-stage profile (JSON) to this path')
+  commands = parser.add_subparsers(dest='command', required=True)
+  
+  download = commands.add_parser('download', help='downloads the datasets and the model weights')
+  download.add_argument('what', nargs='+', choices=['celeba', 'lfw', 'weights'])
+  download.set_defaults(run=command_download)
+  
+  infer = commands.add_parser('infer', help='infers the features of the images in the given folders')
+  infer.add_argument('folders', nargs='+')
+  infer.add_argument('--weights', default=weights_path)
+  infer.add_argument('--features', nargs='+', default=chosen_features, choices=MODEL_FEATURES, metavar='FEATURE')
+  infer.add_argument('--amount', type=int, default=-1, help='images taken from every folder, all by default')
+  infer.add_argument('--sample', type=int, default=None, help='images sampled out of [amount]')
+  infer.add_argument('--seed', type=int, default=51)
+  infer.add_argument('--cache-dir', default='predictions-cache')
+  infer.add_argument('--backend', default='keras', choices=['keras', 'tflite'])
+  infer.add_argument('--quantization', default='float16', choices=['none', 'float16', 'dynamic', 'int8'])
+  infer.add_argument('--calibration', default=None, help='folder of the images calibrating the int8 quantization')
+  infer.add_argument('--calibration-amount', type=int, default=100, help='images taken from --calibration')
+  infer.add_argument('--batch-size', type=int, default=64)
+  infer.add_argument('--output', default='features.npz')
+  infer.set_defaults(run=command_infer)
+  
+  cluster = commands.add_parser('cluster', help='clusters a features file (written by infer)')
+  cluster.add_argument('features')
+  cluster.add_argument('--method', default='kmeans', 
+                       choices=['kmeans', 'minibatch', 'birch', 'agglomerative', 'spectral', 'dbscan', 'optics'])
+  cluster.add_argument('--clusters', type=int, default=16)
+  cluster.add_argument('--eps', type=float, default=1.5)
+  cluster.add_argument('--min-samples', type=int, default=5)
+  cluster.add_argument('--collapse', action='store_true', help='fits the unique feature vectors only')
+  cluster.add_argument('--evaluate', default=None, choices=['full', 'chunked', 'unique', 'sample'])
+  cluster.add_argument('--seed', type=int, default=None)
+  cluster.add_argument('--output', default='clustering', help='folder of the saved clustering')
+  cluster.set_defaults(run=command_cluster)
+  
+  render = commands.add_parser('render', help='renders a clustering (saved by cluster) as an HTML report')
+  render.add_argument('clustering')
+  render.add_argument('--output-dir', default='report')
+  render.add_argument('--img-size', type=int, default=200)
+  render.add_argument('--dpi', type=int, default=100)
+  render.add_argument('--workers', type=int, default=None)
+  render.set_defaults(run=command_render)
+  
+  args = parser.parse_args(argv)
+  
+  if args.profile:
+    profiler.enable()
+  
+  args.run(args)
+  
+  if args.profile:
+    profiler.export(args.profile)
 
-# plot clusters
-Clustering.plot(clusters, rows=4, cols=4, dpi=70)
\ No newline at end of file
+if __name__ == '__main__':
+  main()